@@ -7,13 +7,16 @@ import time
 import ssh_util
 import aft_config as cfg
 
-from os                 import listdir
-from os.path            import dirname, join, realpath
+from os                 import listdir, makedirs
+from os.path            import dirname, join, realpath, expanduser
 from pathlib            import Path
 from subprocess         import Popen, PIPE
+from build_cache        import Build_Cache
+from result_cache       import Result_Cache
 from filestruct_handler import FST_HANDLER
 from consumer_server    import Consumer_Server
 from fuzzing_server     import Fuzzing_Server
+from pipeline_server    import Pipeline_Server
 from diff_server        import Diff_Server
 
 
@@ -29,6 +32,12 @@ class Aftstruct():
         self.rsa_id = None
         self.rsa_pub = None
         self.clients = None
+        self.sessions = {}
+        self.build_cache = None
+        self.result_cache = None
+        self.cache_dir = ""
+        self.image = None
+        self.resume = False
 
     def init_filehandler(self):
         # initialize the file handler and directories
@@ -50,16 +59,38 @@ class Aftstruct():
                     self.alg_dir
                     )
 
+    def init_caches(self):
+        # caches shared between campaigns
+        self.cache_dir = expanduser(self.config['global']['cache directory'])
+        makedirs(self.cache_dir, exist_ok=True)
+        if self.config['global']['build cache']:
+            self.build_cache = Build_Cache(self.cache_dir)
+        if self.config['global']['result cache']:
+            self.result_cache = Result_Cache(self.cache_dir)
+
+    def init_result_store(self):
+        # results in one database instead of one file per run
+        if self.config['global']['result store']:
+            self.fh.open_store()
+
     def get_docker_image(self):
         sys.stdout.write('generating docker image...')
         sys.stdout.flush()
-        self.rsa_id, self.rsa_pub = ssh_util.gen_rsa_key('aft_container_key')
+        # the key is kept so the image only changes with template or dependencies
+        self.rsa_id, self.rsa_pub = ssh_util.gen_rsa_key(
+                join(self.cache_dir, 'aft_container_host_key')
+                )
         self.dockerfile = ssh_util.gen_dockerfile(
                 self.rsa_id,
                 self.config['global']['dependencies']
                 )
+        self.image = ssh_util.get_image_tag(self.dockerfile)
+        if ssh_util.has_image(self.image):
+            sys.stdout.write(' cached\n')
+            sys.stdout.flush()
+            return
         p = Popen(
-                shlex.split('docker build -t aft:1.0 -'),
+                shlex.split('docker build -t {} -'.format(self.image)),
                 stdin=PIPE,
                 stdout=PIPE,
                 stderr=PIPE
@@ -75,17 +106,37 @@ class Aftstruct():
             return
         # create clients
         print('Establishing connection to clients...', end='')
-        self.clients = ssh_util.get_clients(
+        self.clients, timings = ssh_util.get_clients(
                 self.config['global']['workers'],
                 self.rsa_pub,
                 self.config['global']['host keys'],
-                self.config['global']['dependencies']
+                self.image,
+                self.config['global']['startup parallelism']
                 )
+        # one persistent session per client
+        self.sessions = {
+                client: ssh_util.Client_Session(
+                    client,
+                    self.config['global']['bulk transfer count'],
+                    self.config['global']['bulk transfer size']
+                    )
+                for client_list in self.clients.values()
+                for client in client_list
+                }
         print(' done')
+        # startup timing report
+        for worker in timings:
+            for instance, seconds in enumerate(timings[worker]):
+                print('  {} instance {} ready after {:0.2f}s'.format(worker, instance, seconds))
 
     def shutdown_clients(self):
         # shut down clients and stop docker containers
         print('Shutting down clients...', end='')
+        for session in self.sessions.values():
+            session.close()
+        if self.result_cache is not None:
+            self.result_cache.close()
+            self.result_cache = None
         ssh_util.shutdown_clients(
                 self.clients,
                 self.config['global']['workers']
@@ -110,6 +161,19 @@ class Aftstruct():
         # cancel workers
         for worker in self.cs_server.workers:
             worker.cancel()
+        # keep the results the journal already knows about
+        self.fh.close_store()
+        # shutdown clients
+        self.shutdown_clients()
+        sys.exit(0)
+
+    def interrupt_handler_pl(self, sig, frame):
+        print("received {}. shutting down".format(sig))
+        # cancel workers
+        for worker in self.pl_server.workers:
+            worker.cancel()
+        # keep the results the journal already knows about
+        self.fh.close_store()
         # shutdown clients
         self.shutdown_clients()
         sys.exit(0)
@@ -147,38 +211,30 @@ class Aftstruct():
             'queue'
             )))
         # number of outputs by gt
-        num_out_gt = len(listdir(join(
-            self.output_dir,
+        num_out_gt = self.fh.count(
             self.config['global']['ground truth'],
             'tmp'
-            )))
+            )
         # number of crashes by gt
-        num_crash_gt = len(listdir(join(
-            self.output_dir,
+        num_crash_gt = self.fh.count(
             self.config['global']['ground truth'],
             'crashes'
-            )))
+            )
 
         algorithm_html = []
         # per algorithm
         for alg in listdir(self.alg_dir):
             if alg == self.config['global']['ground truth']:
                 continue
-            num_false_alg = len(listdir(join(
-                self.output_dir,
-                alg,
-                'false'
-                )))
-            num_crashes_alg = len(listdir(join(
-                self.output_dir,
-                alg,
-                'crashes'
-                )))
+            num_false_alg = self.fh.count(alg, 'false')
+            num_crashes_alg = self.fh.count(alg, 'crashes')
+            num_slow_alg = self.fh.count(alg, 'slow')
             algorithm_html.append(
                     alg_template.format(
                         alg,
                         num_false_alg,
                         num_crashes_alg,
+                        num_slow_alg,
                         ))
 
 
@@ -197,7 +253,7 @@ class Aftstruct():
 
 
 def usage():
-    print("usage: aft [-i | --input] DIRECTORY [-o | --output] DIRECTORY [-a | --algs] DIRECTORY [-c | --config] FILE")
+    print("usage: aft [-i | --input] DIRECTORY [-o | --output] DIRECTORY [-a | --algs] DIRECTORY [-c | --config] FILE [-r | --resume]")
 
 
 def main(argv):
@@ -205,13 +261,14 @@ def main(argv):
     aft = Aftstruct()
     signal.signal(signal.SIGINT, aft.interrupt_handler)
 
-    opts = "hi:o:a:c:"
+    opts = "hi:o:a:c:r"
     l_opts = [
             "help",
             "input=",
             "output=",
             "alg=",
-            "config="]
+            "config=",
+            "resume"]
     try:
         opts, args = getopt.getopt(argv, opts, l_opts)
     except getopt.GetoptError as err:
@@ -230,6 +287,8 @@ def main(argv):
             aft.alg_dir = arg
         elif opt in ('-c', '--config'):
             aft.config = arg
+        elif opt in ('-r', '--resume'):
+            aft.resume = True
         else:
             usage()
             sys.exit(1)
@@ -239,6 +298,8 @@ def main(argv):
 
     # check config and/or generate new
     aft.check_config()
+    aft.init_caches()
+    aft.init_result_store()
 
     # generate docker image
     aft.get_docker_image()
@@ -246,30 +307,47 @@ def main(argv):
     # create clients
     aft.get_clients()
 
-    # afl stuff goes here
-    a = time.perf_counter()
-    aft.fz_server = Fuzzing_Server(aft)
-    signal.signal(signal.SIGINT, aft.interrupt_handler_fz)
-    aft.fz_server.run()
-    b = time.perf_counter()
-    print(f"Time used for fuzzing was {b-a:0.4f}s")
-
-    # automatic execution of the algorithms
-    aft.cs_server = Consumer_Server(aft)
-    signal.signal(signal.SIGINT, aft.interrupt_handler_cs)
-    aft.cs_server.run()
+    if aft.resume:
+        # the queue of the interrupted run is kept, only the remaining jobs run
+        aft.cs_server = Consumer_Server(aft)
+        signal.signal(signal.SIGINT, aft.interrupt_handler_cs)
+        aft.cs_server.run()
+    elif aft.config['global']['pipeline']:
+        # fuzzing and execution of the algorithms at the same time
+        aft.pl_server = Pipeline_Server(aft)
+        signal.signal(signal.SIGINT, aft.interrupt_handler_pl)
+        aft.pl_server.run()
+    else:
+        # afl stuff goes here
+        a = time.perf_counter()
+        aft.fz_server = Fuzzing_Server(aft)
+        signal.signal(signal.SIGINT, aft.interrupt_handler_fz)
+        aft.fz_server.run()
+        b = time.perf_counter()
+        print(f"Time used for fuzzing was {b-a:0.4f}s")
+
+        # shrink the queue to the inputs needed for the coverage
+        if aft.config['global']['corpus minimization']:
+            aft.fz_server.minimize()
+
+        # automatic execution of the algorithms
+        aft.cs_server = Consumer_Server(aft)
+        signal.signal(signal.SIGINT, aft.interrupt_handler_cs)
+        aft.cs_server.run()
 
     # shut down clients and stop/rm docker containers
     aft.shutdown_clients()
 
-    # diff module
-    aft.df_server = Diff_Server(aft)
-    signal.signal(signal.SIGINT, aft.interrupt_handler_df)
-    aft.df_server.run()
+    # diff module; only needed if outputs were not compared while consuming
+    if not aft.config['global']['inline diff']:
+        aft.df_server = Diff_Server(aft)
+        signal.signal(signal.SIGINT, aft.interrupt_handler_df)
+        aft.df_server.run()
 
     print('Generating index.html...', end='')
     aft.generate_html()
     print('done')
+    aft.fh.close_store()
 
 
 if __name__ == "__main__":
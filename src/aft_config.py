@@ -85,6 +85,38 @@ def check_global_config (global_config):
                 global_config[key] = read_new_val(key, key_type, descr)
         except KeyError:
             global_config[key] = read_new_val(key, key_type, descr)
+    # tuning knobs; these fall back to their defaults instead of asking
+    defaults = [ \
+            ('consumer chunk size', int, 32),\
+            ('consumer prefetch', int, 2),\
+            ('bulk transfer count', int, 16),\
+            ('bulk transfer size', int, 1048576),\
+            ('cache directory', str, '~/.cache/aft'),\
+            ('build cache', bool, True),\
+            ('startup parallelism', int, 8),\
+            ('afl instances per algorithm', int, 1),\
+            ('afl sync interval', int, 60),\
+            ('pipeline', bool, False),\
+            ('pipeline harvest interval', int, 60),\
+            ('inline diff', bool, True),\
+            ('diff workers', int, 0),\
+            ('corpus minimization', bool, False),\
+            ('result cache', bool, True),\
+            ('ground truth first', bool, True),\
+            ('skip inputs failing ground truth', bool, True),\
+            ('performance oracle', bool, False),\
+            ('slow time ratio', (int, float), 10),\
+            ('slow memory ratio', (int, float), 4),\
+            ('slow minimum time', (int, float), 0.05),\
+            ('slow minimum memory', int, 65536),\
+            ('slow repeat runs', int, 3),\
+            ('result store', bool, False),\
+            ('result compression', bool, False),\
+            ('ship output digests', bool, True)\
+            ]
+    for (key, key_type, default) in defaults:
+        if not isinstance(global_config.get(key), key_type):
+            global_config[key] = default
     try:
         workers = global_config['workers']
         for worker in workers:
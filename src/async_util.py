@@ -0,0 +1,20 @@
+import asyncio
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+# thread pool for the blocking calls of the servers
+# one thread per client is enough for every client to be busy at once
+def client_executor(clients):
+    return ThreadPoolExecutor(max_workers=max(1, len(clients)))
+
+
+# run a blocking call (paramiko, sftp, docker, hashing files) in a thread
+# pool, so waiting on one client does not stall the others on the event loop
+async def in_executor(executor, func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+            executor,
+            functools.partial(func, *args)
+            )
@@ -0,0 +1,93 @@
+import hashlib
+import os
+
+from os         import makedirs, replace
+from os.path    import join, isfile, relpath
+from ssh_util   import exec_wait, get_tar, put_archive
+
+
+# file dispatch.py writes into the top directory of a finished build
+build_marker = '.aft-built'
+
+
+class Build_Cache():
+
+    # cache_dir : String (directory holding one tar archive per build)
+    def __init__(self, cache_dir):
+        self.cache_dir = join(cache_dir, 'builds')
+        makedirs(self.cache_dir, exist_ok=True)
+        self.keys = {}
+
+    # hash of everything that influences a build, see source_key
+    # image: String (docker image the build runs in; its libraries and
+    #        toolchain are part of the build)
+    def key(self, alg_path, build_string, variant, image):
+        try:
+            return self.keys[(alg_path, build_string, variant, image)]
+        except KeyError:
+            pass
+        hasher = hashlib.sha256()
+        hasher.update(source_key(alg_path, build_string, variant).encode())
+        hasher.update(image.encode())
+        key = hasher.hexdigest()
+        self.keys[(alg_path, build_string, variant, image)] = key
+        return key
+
+    def get_path(self, key):
+        return join(self.cache_dir, '{}.tar'.format(key))
+
+    def has(self, key):
+        return isfile(self.get_path(key))
+
+    # make a build available on a client
+    # restore it from the cache or build it once on the client and store it
+    # client        : paramiko client
+    # key           : String (from key())
+    # remote_dir    : String (remote directory holding the build)
+    # name          : String (name of the build in remote_dir)
+    # build_command : String (command that builds into remote_dir/name)
+    # returns whether the build is available on the client
+    def provide(self, client, key, remote_dir, name, build_command):
+        if self.has(key):
+            put_archive(client, self.get_path(key), remote_dir)
+            return True
+        if exec_wait(client, build_command) != 0:
+            return False
+        # a tree without marker is not known to be a finished build
+        if exec_wait(client, 'test -f {}/{}/{}'.format(remote_dir, name, build_marker)) != 0:
+            return True
+        # write to a temporary file so a broken transfer never becomes a hit
+        tmp_path = self.get_path(key) + '.part'
+        with open(tmp_path, 'wb') as out_file:
+            get_tar(client, remote_dir, name, out_file)
+        replace(tmp_path, self.get_path(key))
+        return True
+
+
+# hash of everything that influences a build
+# alg_path      : String (file or directory of the algorithm sources)
+# build_string  : String (build command or path to a build script)
+# variant       : String ('run' or the fuzzing mode of the build)
+def source_key(alg_path, build_string, variant):
+    hasher = hashlib.sha256()
+    hasher.update(variant.encode())
+    hasher.update(build_string.encode())
+    if isfile(build_string):
+        hash_file(hasher, build_string)
+    if isfile(alg_path):
+        hash_file(hasher, alg_path)
+    else:
+        for root, dirs, files in os.walk(alg_path):
+            dirs.sort()
+            for f in sorted(files):
+                hasher.update(relpath(join(root, f), alg_path).encode())
+                hash_file(hasher, join(root, f))
+    return hasher.hexdigest()
+
+
+def hash_file(hasher, path):
+    with open(path, 'rb') as f:
+        buf = f.read(1048576)
+        while buf:
+            hasher.update(buf)
+            buf = f.read(1048576)
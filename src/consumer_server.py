@@ -1,12 +1,25 @@
 import asyncio
+import hashlib
 import json
 import os
+import struct
 import sys
 import time
+import zlib
 
 from os         import listdir
 from os.path    import join, isfile, isdir
-from ssh_util   import put_dir
+from ssh_util   import exec_wait
+from async_util         import client_executor, in_executor
+from build_cache        import source_key
+from filestruct_handler import digest_file
+from job_journal        import Job_Journal
+from scheduler          import Scheduler
+
+# changes whenever the outputs of a run are represented differently,
+# so results cached in an older representation are not used
+result_format = 3
+
 
 class Consumer_Server():
 
@@ -14,13 +27,110 @@ class Consumer_Server():
         self.aft = aft
         self.workers = []
         self.ressource_log = {}
+        # algorithm : [cost of every build], kept apart from the runs
+        self.build_log = {}
+        self.runs = 0
+        self.cached_runs = 0
+        # algorithm / input : content hash for the result cache
+        self.algorithm_keys = {}
+        self.input_keys = {}
+        # compare outputs to the ground truth while consuming
+        self.inline_diff = aft.config['global']['inline diff']
+        self.ground_truth = aft.config['global']['ground truth']
+        # run the ground truth on an input before the other algorithms
+        self.ground_truth_first = aft.config['global']['ground truth first']
+        self.skip_failed_ground_truth = self.ground_truth_first \
+                and aft.config['global']['skip inputs failing ground truth']
+        self.skipped = 0
+        # flag runs a lot slower or heavier than the ground truth
+        self.oracle = aft.config['global']['performance oracle']
+        # (algorithm, input) pairs queued for a confirmation run
+        self.suspects = set()
+        self.slow = 0
+        self.num_iuts = len(listdir(aft.alg_dir)) - 1
+        # input : (size, digest) of the output of the ground truth, None if it failed
+        # the outputs themselves stay in tmp, so memory does not grow with them
+        self.reference = {}
+        # input : number of algorithms other than the ground truth that ran on it
+        self.compared = {}
+        # input : [(algorithm, output, usage)] waiting for the ground truth
+        self.pending = {}
+        # only ship outputs that differ from the ground truth, when the
+        # outputs are compared here and nothing else needs them
+        self.ship_digests = self.inline_diff and aft.config['global']['ship output digests']
+        self.omitted = 0
+        # finished jobs, kept on disk so an interrupted campaign can resume
+        self.journal = Job_Journal(
+                join(aft.output_dir, 'journal.jsonl'),
+                aft.resume
+                )
+        self.restore()
+
+
+    # take over the finished jobs of an interrupted run
+    def restore(self):
+        for algorithm, entries in self.journal.jobs.items():
+            self.ressource_log[algorithm] = {
+                    inp: entry['usage'] for inp, entry in entries.items()
+                    }
+        if not self.inline_diff:
+            return
+        for algorithm, entries in self.journal.jobs.items():
+            if algorithm == self.ground_truth:
+                continue
+            for inp in entries:
+                self.compared[inp] = self.compared.get(inp, 0) + 1
+        # the ground truth outputs are still needed for the remaining algorithms
+        for inp, entry in list(self.journal.jobs.get(self.ground_truth, {}).items()):
+            if self.compared.get(inp, 0) == self.num_iuts:
+                del self.compared[inp]
+            elif entry['failed']:
+                self.reference[inp] = None
+            else:
+                output = self.aft.fh.get_output(self.ground_truth, inp)
+                if output is None:
+                    # the output got lost, so the ground truth runs again
+                    self.journal.forget(self.ground_truth, inp)
+                    continue
+                self.reference[inp] = output_key(output)
 
 
     def run(self):
         print('Consumer running')
         # fork and run workers
+        a = time.perf_counter()
         asyncio.run(self.fork_workers())
-        # write the logs
+        b = time.perf_counter()
+        # throughput to compare runs with different numbers of instances
+        print("Consumer executed {} runs on {} clients in {:0.4f}s ({:0.2f} runs/s)".format(
+            self.runs,
+            len(self.aft.sessions),
+            b - a,
+            self.runs / (b - a) if b > a else 0
+            ))
+        self.finish()
+        return
+
+
+    def finish(self):
+        print("Consumer utilisation:\n{}".format(self.queue.summary()))
+        if self.cached_runs:
+            print("{} runs were taken from the result cache".format(self.cached_runs))
+        if self.skipped:
+            print("{} runs were skipped on inputs the ground truth failed on".format(self.skipped))
+        if self.oracle:
+            print("{} of {} suspicious runs were confirmed as slow".format(self.slow, len(self.suspects)))
+        if self.ship_digests:
+            print("{} outputs matched the ground truth on the clients and were not transferred".format(self.omitted))
+        self.flush_pending()
+        self.aft.fh.flush_store()
+        self.journal.write()
+        self.journal.sync()
+        self.journal.close()
+        self.write_logs()
+
+
+    def write_logs(self):
         for algorithm in self.ressource_log:
             with open(
                 join(
@@ -36,37 +146,124 @@ class Consumer_Server():
                                 indent=4
                                 )
                             )
-        return
+            # aggregates to compare the algorithms
+            with open(
+                join(
+                    self.aft.output_dir,
+                    algorithm,
+                    'ressource_stats.json'
+                    ),
+                'w'
+                ) as stats_file:
+                    stats_file.write(
+                            json.dumps(
+                                usage_stats(self.ressource_log[algorithm].values()),
+                                indent=4
+                                )
+                            )
+        for algorithm in self.build_log:
+            with open(
+                join(
+                    self.aft.output_dir,
+                    algorithm,
+                    'build_logs.json'
+                    ),
+                'w'
+                ) as log_file:
+                    log_file.write(
+                            json.dumps(
+                                self.build_log[algorithm],
+                                indent=4
+                                )
+                            )
 
     async def fork_workers(self):
-        self.queue = asyncio.Queue()
-        self.ressource_log_lock = asyncio.Lock()
-        self.fh_lock = asyncio.Lock()
-        self.producer = asyncio.create_task(self.produce())
         clients = [ client for client_list in self.aft.clients.values() for client in client_list ]
+        self.open(clients)
+        self.producer = asyncio.create_task(self.produce())
         self.workers = [ asyncio.create_task(self.consume(client)) for client in clients ]
         await asyncio.gather(self.producer)
         await self.queue.join()
         for worker in self.workers:
             worker.cancel()
-        pass
+        self.close()
+
+    # set up queue, locks and threads of the server inside the event loop
+    def open(self, clients):
+        names = {
+                client: '{} #{}'.format(worker, i)
+                for worker, client_list in self.aft.clients.items()
+                for i, client in enumerate(client_list)
+                }
+        self.queue = Scheduler(
+                {client: names[client] for client in clients},
+                self.aft.config['global']['consumer prefetch']
+                )
+        self.ressource_log_lock = asyncio.Lock()
+        self.fh_lock = asyncio.Lock()
+        self.build_locks = {}
+        self.executor = client_executor(clients)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
 
     async def produce(self):
-        inputs = listdir(self.aft.queue_dir)
-        algorithms = listdir(self.aft.alg_dir)
-        for algorithm in algorithms:
+        await self.feed(listdir(self.aft.queue_dir))
+
+    # queue the runs of all algorithms on new inputs
+    async def feed(self, inputs):
+        if not self.ground_truth_first:
+            await self.put_chunks(listdir(self.aft.alg_dir), inputs)
+            return
+        # the other algorithms are queued by fan_out once the ground truth ran
+        await self.put_chunks([self.ground_truth], inputs)
+        await self.fan_out([
+            inp for inp in inputs if self.journal.done(self.ground_truth, inp)
+            ])
+
+
+    # queue the runs of the algorithms other than the ground truth
+    # inputs the ground truth failed on are dropped, their outputs can not be classified
+    async def fan_out(self, inputs):
+        if self.skip_failed_ground_truth:
+            usable = [
+                    inp for inp in inputs
+                    if not self.journal.failed(self.ground_truth, inp)
+                    ]
             for inp in inputs:
-                await self.queue.put((algorithm, inp))
+                if inp not in usable:
+                    self.reference.pop(inp, None)
+                    self.compared.pop(inp, None)
+            self.skipped += (len(inputs) - len(usable)) * self.num_iuts
+            inputs = usable
+        await self.put_chunks(
+                [ alg for alg in listdir(self.aft.alg_dir) if alg != self.ground_truth ],
+                inputs
+                )
+
+
+    # hand out chunks of inputs to cut down round trips to the clients
+    async def put_chunks(self, algorithms, inputs):
+        chunk_size = max(1, self.aft.config['global']['consumer chunk size'])
+        for algorithm in algorithms:
+            # jobs in the journal finished before aft was interrupted
+            todo = [ inp for inp in inputs if not self.journal.done(algorithm, inp) ]
+            for i in range(0, len(todo), chunk_size):
+                await self.queue.put((algorithm, todo[i:i + chunk_size], 'run'))
 
     async def consume(self, client):
         # setup
-        client.exec_command('mkdir /root/algorithms')
-        client.exec_command('mkdir /root/builds')
-        client.exec_command('mkdir /root/inputs')
-        client.exec_command('mkdir /root/util')
+        session = self.aft.sessions[client]
+        runner = await in_executor(self.executor, self.setup_client, client)
         # consumer loop
         while True:
-            algorithm, inp = await self.queue.get()
+            algorithm, inps, kind = await self.queue.get(client)
+            a = time.perf_counter()
+            if kind == 'confirm':
+                runner = await self.confirm_slow(client, session, runner, algorithm, inps[0])
+                b = time.perf_counter()
+                self.queue.task_done(client, algorithm, b - a, 0)
+                continue
             # if 'hangs' in inp:
             #     print('skipped hang: {}'.format(inp))
             #     self.queue.task_done()
@@ -75,88 +272,516 @@ class Consumer_Server():
             #     print('skipped crash: {}'.format(inp))
             #     self.queue.task_done()
             #     continue
-            sys.stdout.write("running {} with input {}\n".format(algorithm, inp))
-            sys.stdout.flush()
+            # replay the pairs that ran before with the same algorithm and input
+            missing = await self.replay_cached(algorithm, inps)
+            if missing:
+                runner = await self.run_chunk(client, session, runner, algorithm, missing)
+            await self.commit_jobs()
+            # the other algorithms follow once the ground truth ran on the inputs
+            if self.ground_truth_first and algorithm == self.ground_truth:
+                await self.fan_out(inps)
+            b = time.perf_counter()
+            self.queue.task_done(client, algorithm, b - a, len(missing))
+
+
+    # run an algorithm on a chunk of inputs on the client and handle the results
+    # returns the runner, which is replaced if it went away
+    async def run_chunk(self, client, session, runner, algorithm, inps):
+        sys.stdout.write("running {} with {} inputs\n".format(algorithm, len(inps)))
+        sys.stdout.flush()
+        expect = None
+        if self.ship_digests and algorithm != self.ground_truth:
+            # outputs equal to the ground truth stay in the container
+            expect = {
+                    inp: self.reference[inp][1]
+                    for inp in inps
+                    if self.reference.get(inp) is not None
+                    }
+        runner, results = await self.run_files(client, session, runner, algorithm, inps, expect)
+        for result in results:
+            if 'build' in result:
+                self.build_log.setdefault(algorithm, []).append(result['build'])
+            if result.get('stdout omitted'):
+                # the output equals the one of the ground truth
+                result['stdout'] = None
+                self.omitted += 1
+            # cached first, the reference may be dropped once the result is handled
+            self.cache_result(algorithm, result['file'], result)
+            await self.handle_result(algorithm, result['file'], result)
+        if self.aft.result_cache is not None:
+            self.aft.result_cache.commit()
+        self.runs += len(results)
+        return runner
+
+
+    # write the results of the finished jobs in one transaction and only
+    # then the jobs to the journal, so a job in the journal has its results
+    async def commit_jobs(self):
+        async with self.fh_lock:
+            self.aft.fh.flush_store()
+            self.journal.write()
+        self.journal.sync()
+
+
+    # run an algorithm on a list of inputs, which may repeat
+    # returns the runner and the results of the runs
+    # expect: Dictionary (input : digest of the output of the ground truth)
+    async def run_files(self, client, session, runner, algorithm, files, expect=None):
+        build_file = await in_executor(self.executor, self.deliver, session, algorithm, sorted(set(files)))
+        await self.ensure_build(client, session, algorithm, build_file)
+        job = {
+                'alg': algorithm,
+                'imode': self.aft.config[algorithm]['input format'],
+                'omode': self.aft.config[algorithm]['output format'],
+                'exec-args': self.aft.config[algorithm]['execution string'],
+                'build-args': build_file,
+                'files': files,
+                'timeout': self.aft.config['global']['execution time limit']
+                }
+        if expect:
+            job['expect'] = expect
+        return await in_executor(self.executor, self.run_job, client, runner, job)
+
+
+    # queue a confirmation run if an algorithm was a lot slower or heavier
+    # than the ground truth on an input
+    async def check_slow(self, algorithm, inp):
+        if not self.oracle or (algorithm, inp) in self.suspects:
+            return
+        if not self.journal.done(self.ground_truth, inp):
+            return
+        try:
+            reference = self.ressource_log[self.ground_truth][inp]
+            usage = self.ressource_log[algorithm][inp]
+        except KeyError:
+            return
+        if self.journal.failed(self.ground_truth, inp) or not is_slow(
+                reference,
+                usage,
+                self.aft.config['global']
+                ):
+            return
+        self.suspects.add((algorithm, inp))
+        await self.queue.put((algorithm, [inp], 'confirm'))
+
+
+    # run the ground truth and an algorithm a few times on the same client
+    # and keep the input as slow if the best runs still differ that much
+    async def confirm_slow(self, client, session, runner, algorithm, inp):
+        repeats = max(1, self.aft.config['global']['slow repeat runs'])
+        best = {}
+        for alg in (self.ground_truth, algorithm):
+            runner, results = await self.run_files(client, session, runner, alg, [inp] * repeats)
+            usages = [ result['usage'] for result in results if 'wall' in result['usage'] ]
+            if not usages:
+                return runner
+            best[alg] = {
+                    'wall': min(usage['wall'] for usage in usages),
+                    'maxrss': min(usage['maxrss'] for usage in usages),
+                    'timeout': all(usage['timeout'] for usage in usages)
+                    }
+        if is_slow(best[self.ground_truth], best[algorithm], self.aft.config['global']):
+            report = {
+                    'ground truth': best[self.ground_truth],
+                    algorithm: best[algorithm],
+                    'repeats': repeats
+                    }
             async with self.fh_lock:
-                sftp = client.open_sftp()
-                # check whether the algorithm is available
-                if algorithm not in sftp.listdir('algorithms'):
-                    alg_path = join(self.aft.alg_dir, algorithm)
-                    if isfile(alg_path):
-                        sftp.put(
-                                join(self.aft.alg_dir, algorithm),
-                                'algorithms/{}'.format(algorithm))
-                    elif isdir(alg_path):
-                        put_dir(
-                                sftp,
-                                alg_path,
-                                'algorithms/{}'.format(algorithm)
-                                )
-                    else:
-                        sys.stderr.write('Algorithms have to be a file or directory')
-                        sys.stderr.flush()
-                        sys.exit(1)
-                # check whether auxiliary scripts are in place
-                if 'dispatch.py' not in sftp.listdir('util'):
-                    sftp.put(
-                            join(self.aft.aft_dir, 'dispatch.py'),
-                            'util/dispatch.py'
-                            )
-                if isfile(self.aft.config[algorithm]['build string']):
-                    build_file = os.path.split(self.aft.config[algorithm]['build string'])[-1]
-                    if build_file not in sftp.listdir('/root/util'):
-                        sftp.put(
-                                self.aft.config[algorithm]['build string'],
-                                'util/{}'.format(build_file)
-                                )
-                else:
-                    build_file = self.aft.config[algorithm]['build string']
-                # check whether input is available in container
-                if inp not in sftp.listdir('inputs'):
-                    # move input to container
-                    sftp.put(
-                            join(self.aft.queue_dir, inp),
-                            'inputs/{}'.format(inp)
-                            )
-                sftp.close()
-            stdin, stdout, stderr = client.exec_command(
-                    """python3 util/dispatch.py --mode run \
-                        --alg {} --imode {} --omode {} \
-                        --exec-args "{}" --build-args "{}" \
-                        --file {} --timeout {}""".format(
-                            algorithm,
-                            self.aft.config[algorithm]['input format'],
-                            self.aft.config[algorithm]['output format'],
-                            self.aft.config[algorithm]['execution string'],
-                            build_file,
-                            inp,
-                            self.aft.config['global']['execution time limit']
-                            )
+                self.aft.fh.put_slow(algorithm, inp, json.dumps(report, indent=4).encode())
+            self.slow += 1
+        return runner
+
+
+    # handle the cached results of a chunk
+    # returns the inputs that still have to run
+    async def replay_cached(self, algorithm, inps):
+        if self.aft.result_cache is None:
+            return inps
+        alg_key, input_keys = await in_executor(self.executor, self.get_keys, algorithm, inps)
+        missing = []
+        for inp, input_key in zip(inps, input_keys):
+            result = self.aft.result_cache.get(alg_key, input_key)
+            if result is None or not self.replayable(algorithm, inp, result):
+                missing.append(inp)
+            else:
+                await self.handle_result(algorithm, inp, result)
+                self.cached_runs += 1
+        return missing
+
+
+    # whether a cached result holds everything handle_output needs
+    # a stdout kept as digest only is enough if it equals the ground truth
+    def replayable(self, algorithm, inp, result):
+        if result['stdout'] is not None or result['failed']:
+            return True
+        return self.inline_diff \
+                and algorithm != self.ground_truth \
+                and self.reference.get(inp) == (result['stdout size'], result['stdout digest'])
+
+
+    # keep a result in the result cache
+    # the bytes of stdout are only kept if they are written somewhere
+    # when the result is replayed, otherwise its size and digest are enough
+    def cache_result(self, algorithm, inp, result):
+        if self.aft.result_cache is None:
+            return
+        # made up from an error of the dispatcher (e.g. a broken build),
+        # which may be gone with the next run
+        if 'wall' not in result['usage']:
+            return
+        if result['stdout'] is None:
+            size, digest = self.reference[inp]
+        else:
+            # the dispatcher already hashed the outputs it ran
+            size, digest = output_key(result['stdout'], result.get('stdout digest'))
+        if self.inline_diff and (
+                result['failed']
+                or algorithm != self.ground_truth and self.reference.get(inp) == (size, digest)
+                ):
+            # crashes only keep stderr, equal outputs are only compared
+            result = dict(result)
+            result['stdout'] = None
+        self.aft.result_cache.put(
+                self.get_algorithm_key(algorithm),
+                self.get_input_key(inp),
+                result,
+                size,
+                digest
+                )
+
+
+    # content hashes of an algorithm and of inputs for the result cache
+    # hashing reads the files, so it runs in the thread pool
+    def get_keys(self, algorithm, inps):
+        return self.get_algorithm_key(algorithm), [ self.get_input_key(inp) for inp in inps ]
+
+
+    # content hash of an algorithm, its build and everything about how it runs
+    def get_algorithm_key(self, algorithm):
+        try:
+            return self.algorithm_keys[algorithm]
+        except KeyError:
+            pass
+        hasher = hashlib.sha256()
+        hasher.update(source_key(
+            join(self.aft.alg_dir, algorithm),
+            self.aft.config[algorithm]['build string'],
+            'run'
+            ).encode())
+        hasher.update(json.dumps([
+            result_format,
+            self.aft.config[algorithm]['execution string'],
+            self.aft.config[algorithm]['input format'],
+            self.aft.config[algorithm]['output format'],
+            self.aft.config['global']['execution time limit'],
+            self.aft.image
+            ]).encode())
+        self.algorithm_keys[algorithm] = hasher.hexdigest()
+        return self.algorithm_keys[algorithm]
+
+
+    # content hash of an input of the queue
+    def get_input_key(self, inp):
+        try:
+            return self.input_keys[inp]
+        except KeyError:
+            pass
+        self.input_keys[inp] = digest_file(join(self.aft.queue_dir, inp)).hex()
+        return self.input_keys[inp]
+
+
+    # make sure the algorithm is built on the client
+    # every build is done once and then shared over the build cache
+    async def ensure_build(self, client, session, algorithm, build_file):
+        if self.aft.build_cache is None:
+            return
+        # has_file may list the remote directory, so it stays off the loop
+        if await in_executor(self.executor, session.has_file, 'builds', algorithm):
+            return
+        # hashing the sources reads every file of the algorithm
+        key = await in_executor(
+                self.executor,
+                self.aft.build_cache.key,
+                join(self.aft.alg_dir, algorithm),
+                self.aft.config[algorithm]['build string'],
+                'run',
+                self.aft.image
+                )
+        async with self.build_locks.setdefault(key, asyncio.Lock()):
+            cached = self.aft.build_cache.has(key)
+            a = time.perf_counter()
+            built = await in_executor(
+                    self.executor,
+                    self.aft.build_cache.provide,
+                    client,
+                    key,
+                    'builds',
+                    algorithm,
+                    'python3 util/dispatch.py --mode build --alg {} --build-args "{}"'.format(
+                        algorithm,
+                        build_file
+                        )
+                    )
+            b = time.perf_counter()
+        self.build_log.setdefault(algorithm, []).append({'wall': b - a, 'cached': cached})
+        # a failing build is left to the runner, which reports it per input
+        if built:
+            await in_executor(self.executor, self.add_build, session, algorithm)
+
+
+    def add_build(self, session, algorithm):
+        session.remote_files('builds').add(algorithm)
+
+
+    # prepare the directories of a client and start its runner
+    def setup_client(self, client):
+        exec_wait(
+                client,
+                'mkdir -p /root/algorithms /root/builds /root/inputs /root/util'
+                )
+        # the runner has to be in place before it is started
+        self.aft.sessions[client].put_files(
+                [(join(self.aft.aft_dir, 'dispatch.py'), 'dispatch.py')],
+                'util'
+                )
+        return self.start_runner(client)
+
+
+    # move the algorithm, its build script and the inputs of a job to the client
+    # returns the build argument for the dispatcher
+    def deliver(self, session, algorithm, inps):
+        # check whether the algorithm is available
+        if not session.has_file('algorithms', algorithm):
+            alg_path = join(self.aft.alg_dir, algorithm)
+            if isfile(alg_path) or isdir(alg_path):
+                session.put_tree(alg_path, 'algorithms', algorithm)
+            else:
+                sys.stderr.write('Algorithms have to be a file or directory')
+                sys.stderr.flush()
+                sys.exit(1)
+        # check whether auxiliary scripts are in place
+        if isfile(self.aft.config[algorithm]['build string']):
+            build_file = os.path.split(self.aft.config[algorithm]['build string'])[-1]
+            if not session.has_file('util', build_file):
+                session.put_files(
+                        [(self.aft.config[algorithm]['build string'], build_file)],
+                        'util'
                         )
+        else:
+            build_file = self.aft.config[algorithm]['build string']
+        # check whether inputs are available in container
+        # move missing inputs of the chunk to the container
+        session.put_files(
+                [
+                    (join(self.aft.queue_dir, inp), inp)
+                    for inp in inps if not session.has_file('inputs', inp)
+                    ],
+                'inputs'
+                )
+        return build_file
+
+
+    # log the ressource usage of a run and write its output
+    # result: {'failed', 'stdout', 'stderr', 'usage'} with bytes outputs;
+    #         stdout is None if it matched the ground truth in the container
+    async def handle_result(self, algorithm, inp, result):
+        # log the algorithm and input
+        async with self.ressource_log_lock:
             try:
-                json_data = json.load(stdout)
-            except JSONDecodeError:
-                print(output)
-            # log the algorithm and input
-            async with self.ressource_log_lock:
-                try:
-                    self.ressource_log[algorithm]
-                except KeyError:
-                    self.ressource_log[algorithm] = {}
-                self.ressource_log[algorithm][inp] = json_data['usage']
-            async with self.fh_lock:
-                if json_data['failed']:
-                    # write to crashes
-                    if not json_data['stderr']:
-                        json_data['stderr'] = "";
-                    crash_file = self.aft.fh.get_crash_handle(algorithm, inp)
-                    crash_file.write('\n'.join(json_data['stderr']))
-                    crash_file.close()
+                self.ressource_log[algorithm]
+            except KeyError:
+                self.ressource_log[algorithm] = {}
+            self.ressource_log[algorithm][inp] = result['usage']
+        await self.handle_output(algorithm, inp, result)
+        # the journal knows by now whether the ground truth failed
+        if algorithm != self.ground_truth:
+            await self.check_slow(algorithm, inp)
+        else:
+            for iut in self.ressource_log:
+                if iut != self.ground_truth and inp in self.ressource_log[iut]:
+                    await self.check_slow(iut, inp)
+
+
+    # write the output of a run or compare it to the ground truth
+    async def handle_output(self, algorithm, inp, result):
+        stdout = result['stdout']
+        stderr = result['stderr']
+        async with self.fh_lock:
+            if result['failed']:
+                # write to crashes
+                self.aft.fh.put_crash(algorithm, inp, stderr)
+            elif not self.inline_diff:
+                # write outputs to tmp
+                self.aft.fh.put_output(algorithm, inp, stdout)
+            if not self.inline_diff:
+                self.journal.append(algorithm, inp, result['failed'], result['usage'])
+                return
+            if algorithm == self.ground_truth:
+                if not result['failed']:
+                    self.aft.fh.put_output(algorithm, inp, stdout)
+                self.journal.append(algorithm, inp, result['failed'], result['usage'])
+                # a failed ground truth leaves nothing to compare against
+                if result['failed']:
+                    self.reference[inp] = None
                 else:
-                    # write outputs to tmp
-                    if not json_data['stdout']:
-                        json_data['stdout'] = ""
-                    tmp_file = self.aft.fh.get_tmp_handle(algorithm, inp)
-                    tmp_file.write('\n'.join(json_data['stdout']))
-                    tmp_file.close()
-            self.queue.task_done()
+                    self.reference[inp] = output_key(stdout, result.get('stdout digest'))
+                for iut, output, usage in self.pending.pop(inp, []):
+                    self.compare(iut, inp, output)
+                    self.journal.append(iut, inp, False, usage)
+            else:
+                self.compared[inp] = self.compared.get(inp, 0) + 1
+                if result['failed']:
+                    # crashes were written above
+                    self.journal.append(algorithm, inp, True, result['usage'])
+                elif stdout is None:
+                    # matched the ground truth in the container
+                    self.journal.append(algorithm, inp, False, result['usage'])
+                elif inp in self.reference:
+                    self.compare(algorithm, inp, stdout, result.get('stdout digest'))
+                    self.journal.append(algorithm, inp, False, result['usage'])
+                else:
+                    # hold the output until the ground truth ran on the input
+                    # it only counts as finished once it was compared
+                    self.pending.setdefault(inp, []).append((algorithm, stdout, result['usage']))
+            # forget the reference once every algorithm ran on the input
+            if inp in self.reference and self.compared.get(inp, 0) == self.num_iuts:
+                del self.reference[inp]
+                del self.compared[inp]
+
+
+    # compare an output to the one of the ground truth and keep it if false
+    # digest: String (digest of the output computed by the dispatcher)
+    def compare(self, algorithm, inp, output, digest=None):
+        if output_key(output, digest) != self.reference[inp]:
+            self.aft.fh.put_false(algorithm, inp, output)
+
+
+    # write the outputs still waiting for a ground truth that never came
+    def flush_pending(self):
+        for inp, outputs in self.pending.items():
+            for algorithm, output, usage in outputs:
+                self.aft.fh.put_false(algorithm, inp, output)
+                self.journal.append(algorithm, inp, False, usage)
+        self.pending = {}
+
+
+    # start the long-lived dispatcher on the client
+    # its stderr (build output, tracebacks) goes to a log in the container;
+    # unread on the channel it would use up the window and stall stdout
+    # returns the stdin and stdout of the runner channel
+    def start_runner(self, client):
+        stdin, stdout, stderr = client.exec_command(
+                'python3 util/dispatch.py --mode serve 2>>util/runner.log'
+                )
+        return stdin, stdout
+
+
+    # send a job to the runner and read one result frame per input
+    # restarts the runner once if it went away
+    def run_job(self, client, runner, job):
+        job['compress'] = self.aft.config['global']['result compression']
+        for attempt in range(2):
+            runner_in, runner_out = runner
+            results = []
+            try:
+                runner_in.write(json.dumps(job) + '\n')
+                runner_in.flush()
+                for inp in job['files']:
+                    result = read_frame(runner_out)
+                    if result is None:
+                        break
+                    results.append(result)
+            except OSError:
+                pass
+            if len(results) == len(job['files']):
+                return runner, results
+            runner = self.start_runner(client)
+        sys.stderr.write('runner on client stopped responding\n')
+        sys.stderr.flush()
+        sys.exit(1)
+
+
+# what an output is compared by: its size and BLAKE2b digest
+# digest: String (digest already computed by the dispatcher)
+def output_key(data, digest=None):
+    if digest is None:
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    return len(data), digest
+
+
+# read exactly size bytes from a channel
+# returns None if the channel closed before
+def read_exact(stream, size):
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+# read a result frame of the dispatcher
+# returns the header with the raw stdout and stderr bytes, None at the end
+def read_frame(stream):
+    size = read_exact(stream, 4)
+    if size is None:
+        return None
+    header = read_exact(stream, struct.unpack('>I', size)[0])
+    if header is None:
+        return None
+    result = json.loads(header)
+    for name in ('stdout', 'stderr'):
+        data = read_exact(stream, result.pop(name + ' size'))
+        if data is None:
+            return None
+        if result.pop(name + ' zlib'):
+            data = zlib.decompress(data)
+        result[name] = data
+    return result
+
+
+# fields of the ressource usage that are aggregated per algorithm
+stat_fields = ['wall', 'utime', 'stime', 'maxrss']
+
+
+# mean, median, 95th percentile and maximum of the runs of an algorithm
+# usages: Iterable of usage dictionaries of the dispatcher
+def usage_stats(usages):
+    usages = [ usage for usage in usages if 'wall' in usage ]
+    stats = {
+            'runs': len(usages),
+            'timeouts': sum(1 for usage in usages if usage['timeout'])
+            }
+    for field in stat_fields:
+        values = sorted(usage[field] for usage in usages)
+        if not values:
+            continue
+        stats[field] = {
+                'mean': sum(values) / len(values),
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'max': values[-1]
+                }
+    return stats
+
+
+# nearest rank percentile of sorted values
+def percentile(values, p):
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+# whether a run took much more time or memory than the ground truth
+# the time and peak RSS (KiB) of the ground truth are raised to a minimum,
+# so noise on tiny runtimes and a larger runtime of the language an
+# algorithm is written in are not flagged
+def is_slow(reference, usage, config):
+    if 'wall' not in reference or 'wall' not in usage or reference['timeout']:
+        return False
+    time_floor = max(reference['wall'], config['slow minimum time'])
+    memory_floor = max(reference['maxrss'], config['slow minimum memory'])
+    return usage['timeout'] \
+            or usage['wall'] >= config['slow time ratio'] * time_floor \
+            or usage['maxrss'] >= config['slow memory ratio'] * memory_floor
@@ -1,56 +1,156 @@
+import math
 import os
 import sys
+import time
 
 from os         import listdir
-from os.path    import join
+from os.path    import join, getsize, isfile, isdir
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from filestruct_handler import digest_file
 
 
 class Diff_Server():
 
     def __init__(self, aft):
         self.aft = aft
+        self.workers = []
 
 
     def run(self):
         print('Diff running')
         # generate list of algorithms
-        algorithms = os.listdir(self.aft.output_dir)
+        # the output directory also holds the indices and logs of the campaign
+        algorithms = [
+                algorithm for algorithm in os.listdir(self.aft.output_dir)
+                if isdir(join(self.aft.output_dir, algorithm))
+                ]
         algorithms.remove('queue')
         if self.aft.config['global']['ground truth'] not in algorithms:
             sys.stderr.write("No outputs of ground truth found. Aborting...")
             sys.stderr.flush
             sys.exit(1)
+        if self.aft.fh.store is not None:
+            self.diff_store()
+            return
 
-        # load and store outputs from ground truth
-        reference_dict = {}
         gt_path = join(
             self.aft.output_dir,
             self.aft.config['global']['ground truth'],
             'tmp'
             )
-        for output in listdir(gt_path):
-            with open(join(gt_path, output), 'r') as data:
-                reference_dict[output] = data.read()
-        del gt_path
-
-        # compare outputs of algorithms to reference
         algorithms.remove(self.aft.config['global']['ground truth'])
+        alg_paths = {
+                algorithm: join(self.aft.output_dir, algorithm, 'tmp')
+                for algorithm in algorithms
+                }
+        # algorithm : outputs to compare
+        outputs = {
+                algorithm: set(listdir(alg_paths[algorithm]))
+                for algorithm in algorithms
+                }
+
+        # shard the inputs, so every shard reads a ground truth output once
+        # for all algorithms
+        inputs = sorted(set().union(*outputs.values()))
+        num_workers = self.aft.config['global']['diff workers'] or os.cpu_count()
+        chunk_size = max(1, math.ceil(len(inputs) / (num_workers * 4)))
+        timing = dict.fromkeys(algorithms, 0.0)
+        false = {algorithm: [] for algorithm in algorithms}
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            self.workers = [
+                    executor.submit(
+                        diff_shard,
+                        gt_path,
+                        alg_paths,
+                        {
+                            algorithm: [inp for inp in shard if inp in outputs[algorithm]]
+                            for algorithm in algorithms
+                            }
+                        )
+                    for shard in (
+                        inputs[i:i + chunk_size]
+                        for i in range(0, len(inputs), chunk_size)
+                        )
+                    ]
+            for worker in as_completed(self.workers):
+                shard_false, shard_timing = worker.result()
+                for algorithm in algorithms:
+                    false[algorithm] += shard_false[algorithm]
+                    timing[algorithm] += shard_timing[algorithm]
+
+        # move the false outputs and clean up
         for algorithm in algorithms:
-            alg_path = join(
-                    self.aft.output_dir,
-                    algorithm,
-                    'tmp'
-                    )
-            for output in listdir(alg_path):
-                with open(join(alg_path, output), 'r') as data:
-                    alg_output = data.read()
-                    try:
-                        if alg_output != reference_dict[output]:
-                            self.aft.fh.put_false(algorithm, output)
-                    except KeyError:
-                        self.aft.fh.put_false(algorithm, output)
+            for output in false[algorithm]:
+                self.aft.fh.put_false(algorithm, output)
             # clean and remove the tmp directory of algorithm
-            for output in listdir(alg_path):
-                os.remove(join(alg_path, output))
-            os.rmdir(alg_path)
+            for output in listdir(alg_paths[algorithm]):
+                os.remove(join(alg_paths[algorithm], output))
+            os.rmdir(alg_paths[algorithm])
+            print("  {}: {} false outputs, {:0.4f}s comparing".format(
+                algorithm,
+                len(false[algorithm]),
+                timing[algorithm]
+                ))
         return
+
+
+    # compare the outputs with one query on the result store
+    def diff_store(self):
+        a = time.perf_counter()
+        false = self.aft.fh.store.diff(self.aft.config['global']['ground truth'])
+        b = time.perf_counter()
+        for algorithm in listdir(self.aft.alg_dir):
+            if algorithm == self.aft.config['global']['ground truth']:
+                continue
+            print("  {}: {} false outputs".format(algorithm, false.get(algorithm, 0)))
+        print("  compared in {:0.4f}s".format(b - a))
+
+
+# compare one shard of outputs of every algorithm to the ground truth
+# runs in a worker process of the diff server
+# alg_paths : {algorithm : directory with its outputs}
+# outputs   : {algorithm : names of outputs in this shard}
+# returns the false outputs and the time spent per algorithm
+def diff_shard(gt_path, alg_paths, outputs):
+    reference = Reference_Index(
+            gt_path,
+            set().union(*outputs.values())
+            )
+    false = {}
+    timing = {}
+    for algorithm in outputs:
+        a = time.perf_counter()
+        false[algorithm] = [
+                output for output in outputs[algorithm]
+                if not reference.matches(output, join(alg_paths[algorithm], output))
+                ]
+        timing[algorithm] = time.perf_counter() - a
+    return false, timing
+
+
+class Reference_Index():
+
+    # gt_path: String (directory with the outputs of the ground truth)
+    # outputs: Set of String (outputs to index, all if None)
+    def __init__(self, gt_path, outputs=None):
+        self.gt_path = gt_path
+        if outputs is None:
+            outputs = listdir(gt_path)
+        # output : [size, digest or None until needed]
+        self.index = {
+                output: [getsize(join(gt_path, output)), None]
+                for output in outputs
+                if isfile(join(gt_path, output))
+                }
+
+    # check whether a file equals the ground truth output of the same name
+    def matches(self, output, path):
+        try:
+            entry = self.index[output]
+        except KeyError:
+            return False
+        if getsize(path) != entry[0]:
+            return False
+        if entry[1] is None:
+            entry[1] = digest_file(join(self.gt_path, output))
+        return digest_file(path) == entry[1]
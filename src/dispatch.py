@@ -1,27 +1,28 @@
 import getopt
+import hashlib
 import json
 import os
 import shlex
+import shutil
+import struct
 import subprocess
 import sys
+import threading
 import time
+import zlib
 
 from os         import listdir, chdir, mkdir, getcwd
-from os.path    import join
+from os.path    import join, isdir, isfile, realpath
 from resource   import getrusage, RUSAGE_CHILDREN
-from signal     import SIGINT, SIGTERM
-from subprocess import Popen, PIPE, STDOUT, DEVNULL, TimeoutExpired
+from signal     import SIGINT, SIGKILL, SIGTERM
+from subprocess import Popen, PIPE, STDOUT, DEVNULL
 
 
-def dispatch_fuzzing(algorithm, input_mode, output_mode, exec_args, build_args, fuzzing_mode, timeout, max_cycle):
-    os.chdir('workdir')
-
-    # load build script
-    if build_args in listdir('/root/util'):
-        with open('/root/util/{}'.format(build_args)) as f:
-            build_script = f.read().splitlines()
-    else:
-        build_script = [build_args]
+# build the instrumented variant of an algorithm in the current directory
+# needs_build: Boolean (False only follows the cd and export lines of an
+#              already built tree, e.g. one restored from the build cache)
+def build_instrumented(build_args, fuzzing_mode, needs_build=True):
+    build_script = load_build_script(build_args)
 
     # build the algorithm
     environment = os.environ.copy()
@@ -35,7 +36,7 @@ def dispatch_fuzzing(algorithm, input_mode, output_mode, exec_args, build_args,
             elif 'export' in line:
                 var = line[7:].split('=')
                 environment[var[0]] = var[1]
-            else:
+            elif needs_build:
                 proc = subprocess.run(
                         line,
                         shell=True,
@@ -55,7 +56,7 @@ def dispatch_fuzzing(algorithm, input_mode, output_mode, exec_args, build_args,
             elif 'export' in line:
                 var = line[7:].split('=')
                 environment[var[0]] = var[1]
-            else:
+            elif needs_build:
                 environment['CC'] = "afl-gcc-fast"
                 environment['CXX'] = "afl-g++-fast"
                 proc = subprocess.run(
@@ -77,7 +78,7 @@ def dispatch_fuzzing(algorithm, input_mode, output_mode, exec_args, build_args,
             elif 'export' in line:
                 var = line[7:].split('=')
                 environment[var[0]] = var[1]
-            else:
+            elif needs_build:
                 environment['CC'] = "afl-clang-lto"
                 environment['CXX'] = "afl-clang-lto++"
                 proc = subprocess.run(
@@ -90,10 +91,27 @@ def dispatch_fuzzing(algorithm, input_mode, output_mode, exec_args, build_args,
     else:
         print('unknown fuzzing mode')
         sys.exit(1)
+    return environment
+
+
+# instance: String ('default' for a single afl++ instance, 'main' for the
+#           -M instance or the name of a -S instance of a parallel campaign)
+def dispatch_fuzzing(algorithm, input_mode, output_mode, exec_args, build_args, fuzzing_mode, timeout, max_cycle, prebuilt=False, instance='default'):
+    os.chdir('workdir')
+
+    # build the algorithm
+    build_instrumented(build_args, fuzzing_mode, not prebuilt)
 
     # run the fuzzer
     qemu = '-Q' if fuzzing_mode == '1' else ''
-    fuzzing_command = 'afl-fuzz -i /root/inputs -o out -V {} -m none -d -L -1 {} -- {}'.format(timeout, qemu, exec_args)
+    if instance == 'main':
+        parallel = '-M main'
+    elif instance != 'default':
+        parallel = '-S {}'.format(instance)
+    else:
+        parallel = ''
+    # the output is kept in workdir whatever directory the build ended in
+    fuzzing_command = 'afl-fuzz -i /root/inputs -o /root/workdir/out {} -V {} -m none -d -L -1 {} -- {}'.format(parallel, timeout, qemu, exec_args)
     fuzzer = Popen(
             shlex.split(fuzzing_command),
             stdout=PIPE,
@@ -114,52 +132,82 @@ def dispatch_fuzzing(algorithm, input_mode, output_mode, exec_args, build_args,
                     fuzzer.send_signal(SIGINT)
 
 
-def dispatch_consuming(algorithm, input_mode, output_mode, exec_args, build_args, input_name, timeout):
-    # named fields procduced by the getusage syscall
-    usage_fields = [
-            'utime',
-            'stime',
-            'maxrss',
-            'ixrss',
-            'idrss',
-            'isrss',
-            'minflt',
-            'majflt',
-            'nswap',
-            'inblock',
-            'oublock',
-            'msgsnd',
-            'msgrcv',
-            'nsignals',
-            'nvcsw',
-            'nivscw'
-            ]
-    output = {}
+# named fields procduced by the getusage syscall
+usage_fields = [
+        'utime',
+        'stime',
+        'maxrss',
+        'ixrss',
+        'idrss',
+        'isrss',
+        'minflt',
+        'majflt',
+        'nswap',
+        'inblock',
+        'oublock',
+        'msgsnd',
+        'msgrcv',
+        'nsignals',
+        'nvcsw',
+        'nivscw'
+        ]
 
-    # fix path
-    if getcwd() != '/root':
-        chdir('/root')
+# algorithms prepared by this process
+# algorithm : (working directory, environment) after the build script
+builds = {}
+
+# algorithms whose build failed in this process
+# algorithm : exception of the build
+build_errors = {}
 
-    # load build script
+# cost of the builds done by this process, reported with the next run
+# algorithm : usage dictionary of the build
+build_costs = {}
+
+# file written into the top directory of a build once it succeeded;
+# the build cache only stores trees that have it
+build_marker = '.aft-built'
+
+
+def load_build_script(build_args):
     if build_args in listdir('/root/util'):
         with open('/root/util/{}'.format(build_args)) as f:
-            build_script = f.read().splitlines()
-    else:
-        build_script = [build_args]
+            return f.read().splitlines()
+    return [build_args]
+
 
-    if algorithm not in listdir('/root/builds'):
-        mkdir('/root/builds/{}'.format(algorithm))
+def prepare_algorithm(algorithm, build_args):
+    if algorithm in builds:
+        return builds[algorithm]
+    if algorithm in build_errors:
+        raise build_errors[algorithm]
+
+    # fix path
+    chdir('/root')
+    build_script = load_build_script(build_args)
+
+    # only build if no earlier process did; otherwise just follow the
+    # cd and export lines to restore the working directory and environment
+    build_dir = '/root/builds/{}'.format(algorithm)
+    needs_build = not isfile(join(build_dir, build_marker))
+    start = time.perf_counter()
+    before = getrusage(RUSAGE_CHILDREN)
+    if needs_build:
+        # a tree without marker is left from a failed or interrupted build
+        shutil.rmtree(build_dir, ignore_errors=True)
+        mkdir(build_dir)
         os.system('cp -R /root/algorithms/{} /root/builds/{}/{}'.format(algorithm, algorithm, algorithm))
-        # build the algorithm
-        chdir('builds/{}'.format(algorithm))
-        environment = os.environ.copy()
+    # build the algorithm
+    chdir(build_dir)
+    environment = os.environ.copy()
+    try:
         for line in build_script:
             if 'cd' in line:
                 chdir(line[3:])
             elif 'export' in line:
                 var = line[7:].split('=')
                 environment[var[0]] = var[1]
-            else:
+            elif needs_build:
                 proc = subprocess.run(
                         shlex.split(line),
                         shell=True,
@@ -167,13 +215,91 @@ def dispatch_consuming(algorithm, input_mode, output_mode, exec_args, build_args
                         check=True,
                         env=environment
                         )
+    except Exception as err:
+        # never leave a half built tree that a later process would take
+        # for a finished build
+        chdir('/root')
+        if needs_build:
+            shutil.rmtree(build_dir, ignore_errors=True)
+        build_errors[algorithm] = err
+        raise
+    builds[algorithm] = (getcwd(), environment)
+    if needs_build:
+        open(join(build_dir, build_marker), 'w').close()
+        # children reaped with wait4 count in RUSAGE_CHILDREN as well, so the
+        # difference is the cost of the build only because nothing else runs
+        # while the algorithm is built
+        after = getrusage(RUSAGE_CHILDREN)
+        build_costs[algorithm] = {
+                'wall': time.perf_counter() - start,
+                'utime': after.ru_utime - before.ru_utime,
+                'stime': after.ru_stime - before.ru_stime
+                }
+    return builds[algorithm]
+
+
+# wait for a process like communicate, but reap it with wait4
+# to get the ressource usage of exactly this process
+# returns stdout, stderr, usage dictionary
+def communicate_measured(process, data, timeout):
+    timed_out = threading.Event()
+    # os.kill instead of process.kill, which polls first and may reap the
+    # process before the wait4 below
+    def kill():
+        timed_out.set()
+        try:
+            os.kill(process.pid, SIGKILL)
+        except ProcessLookupError:
+            # reaped just before the timer was cancelled
+            pass
+    timer = threading.Timer(timeout, kill)
+    streams = {}
+    def drain(name, pipe):
+        streams[name] = pipe.read()
+        pipe.close()
+    readers = [
+            threading.Thread(target=drain, args=('stdout', process.stdout)),
+            threading.Thread(target=drain, args=('stderr', process.stderr))
+            ]
+    start = time.perf_counter()
+    timer.start()
+    for reader in readers:
+        reader.start()
+    try:
+        if data:
+            process.stdin.write(data)
+        process.stdin.close()
+    except BrokenPipeError:
+        # the algorithm did not read all of its input
+        pass
+    pid, status, rusage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    timer.cancel()
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
     else:
-        chdir('builds/{}'.format(algorithm))
+        process.returncode = os.WEXITSTATUS(status)
+    for reader in readers:
+        reader.join()
+    usage = {}
+    for field_name, val in zip(usage_fields, rusage):
+        usage[field_name] = val
+    usage['wall'] = wall
+    usage['timeout'] = timed_out.is_set()
+    return streams['stdout'], streams['stderr'], usage
+
+
+def run_algorithm(algorithm, input_mode, output_mode, exec_args, build_args, input_name, timeout, input_dir='/root/inputs'):
+    output = {}
+    input_path = join(input_dir, input_name)
+
+    workdir, environment = prepare_algorithm(algorithm, build_args)
+    chdir(workdir)
 
     # if input file is required replace the command
     if input_mode == '1':
         # stdin
-        with open('/root/inputs/{}'.format(input_name), 'rb') as in_file:
+        with open(input_path, 'rb') as in_file:
             data = in_file.read()
         pass
     elif input_mode == '2':
@@ -181,7 +307,7 @@ def dispatch_consuming(algorithm, input_mode, output_mode, exec_args, build_args
         data = None
         exec_args = exec_args.replace(
                 '@@',
-                '/root/inputs/{}'.format(input_name)
+                input_path
                 )
     else:
         # error
@@ -194,28 +320,190 @@ def dispatch_consuming(algorithm, input_mode, output_mode, exec_args, build_args
             stdout=PIPE,
             stderr=PIPE
             )
-    try:
-        stdout, stderr = process.communicate(data, timeout=int(timeout))
-    except TimeoutExpired:
-        process.kill()
-        stdout, stderr = process.communicate()
+    stdout, stderr, usage = communicate_measured(process, data, int(timeout))
     # capture returncode and add to output
     output['failed'] = True if process.returncode != 0 else False
-    # capture stdout and stderr and add to output
-    output['stdout'] = []
-    for line in stdout.decode().splitlines():
-        output['stdout'].append(line)
-    output['stderr'] = []
-    for line in stderr.decode().splitlines():
-        output['stderr'].append(line)
-
-    # generate the usage dictionary and add to output
-    output['usage'] = {}
-    for field_name, val in zip(usage_fields, getrusage(RUSAGE_CHILDREN)):
-        output['usage'][field_name] = val
+    # outputs are kept as the bytes the algorithm wrote
+    output['stdout'] = stdout
+    output['stderr'] = stderr
+
+    # usage of this run alone, wall time in seconds and maxrss in KiB
+    output['usage'] = usage
+    # the build this run waited for is reported once and apart from the run
+    if algorithm in build_costs:
+        output['build'] = build_costs.pop(algorithm)
+
+    return output
 
+
+def dispatch_consuming(algorithm, input_mode, output_mode, exec_args, build_args, input_name, timeout):
+    output = run_algorithm(
+            algorithm,
+            input_mode,
+            output_mode,
+            exec_args,
+            build_args,
+            input_name,
+            timeout
+            )
     # write the info in json
-    print(json.dumps(output))
+    print(json.dumps(text_result(output)))
+
+
+# json friendly copy of a result with the outputs split into lines of text
+def text_result(output):
+    output = dict(output)
+    output['stdout'] = output['stdout'].decode(errors='replace').splitlines()
+    output['stderr'] = output['stderr'].decode(errors='replace').splitlines()
+    return output
+
+
+# run a list of inputs in one process and emit one json line per input
+# as soon as it finished (json lines)
+def dispatch_batch(algorithm, input_mode, output_mode, exec_args, build_args, input_names, timeout, input_dir='/root/inputs'):
+    for output in run_batch(algorithm, input_mode, output_mode, exec_args, build_args, input_names, timeout, input_dir):
+        sys.stdout.write(json.dumps(text_result(output)) + '\n')
+        sys.stdout.flush()
+
+
+# run a list of inputs and yield the result of every input
+def run_batch(algorithm, input_mode, output_mode, exec_args, build_args, input_names, timeout, input_dir='/root/inputs'):
+    for input_name in input_names:
+        try:
+            output = run_algorithm(
+                    algorithm,
+                    input_mode,
+                    output_mode,
+                    exec_args,
+                    build_args,
+                    input_name,
+                    timeout,
+                    input_dir
+                    )
+        except Exception as err:
+            # report errors (e.g. a failing build) as a failed run
+            output = {
+                    'failed': True,
+                    'stdout': b'',
+                    'stderr': repr(err).encode(),
+                    'usage': {}
+                    }
+        output['file'] = input_name
+        yield output
+
+
+# outputs smaller than this are never compressed
+compress_threshold = 4096
+
+
+# write a result as one frame:
+# 4 byte big endian length of the json header, the header, stdout, stderr
+# the header holds the lengths of the outputs as sent and whether they are
+# compressed, so the host reads the outputs without decoding them
+# expected: String (digest of the ground truth output for this input);
+#           a stdout with this digest is left out of the frame
+def write_frame(stream, output, compress=False, expected=None):
+    header = { key: val for key, val in output.items() if key not in ('stdout', 'stderr') }
+    header['stdout digest'] = hashlib.blake2b(output['stdout'], digest_size=16).hexdigest()
+    header['stdout omitted'] = header['stdout digest'] == expected
+    streams = []
+    for name in ('stdout', 'stderr'):
+        data = output[name]
+        if name == 'stdout' and header['stdout omitted']:
+            data = b''
+        header[name + ' zlib'] = False
+        if compress and len(data) >= compress_threshold:
+            packed = zlib.compress(data, 1)
+            if len(packed) < len(data):
+                data = packed
+                header[name + ' zlib'] = True
+        header[name + ' size'] = len(data)
+        streams.append(data)
+    header = json.dumps(header).encode()
+    stream.write(struct.pack('>I', len(header)))
+    stream.write(header)
+    for data in streams:
+        stream.write(data)
+    stream.flush()
+
+
+# read the input names of a batch
+# manifest: String (file with one input name per line or a directory)
+# returns the input names and the directory they are located in
+def load_manifest(manifest):
+    if isdir(manifest):
+        return sorted(listdir(manifest)), realpath(manifest)
+    with open(manifest) as f:
+        input_names = [line.strip() for line in f if line.strip()]
+    return input_names, '/root/inputs'
+
+
+# minimize the inputs in /root/queue for the coverage of an algorithm
+# prints the names of the inputs afl-cmin kept as json
+def dispatch_minimizing(algorithm, exec_args, build_args, fuzzing_mode, prebuilt=False):
+    os.chdir('/root/workdir')
+
+    # build the algorithm
+    build_instrumented(build_args, fuzzing_mode, not prebuilt)
+
+    # run the minimizer
+    qemu = '-Q' if fuzzing_mode == '1' else ''
+    subprocess.run(['rm', '-rf', '/root/workdir/cmin'])
+    minimizing_command = 'afl-cmin -i /root/queue -o /root/workdir/cmin {} -- {}'.format(qemu, exec_args)
+    # without AFL_CMIN_ALLOW_ANY afl-cmin drops inputs that crash or hang,
+    # which are the most interesting ones for the differential testing
+    environment = os.environ.copy()
+    environment['AFL_CMIN_ALLOW_ANY'] = '1'
+    proc = subprocess.run(
+            shlex.split(minimizing_command),
+            stdout=DEVNULL,
+            stderr=DEVNULL,
+            env=environment
+            )
+    if proc.returncode == 0:
+        kept = listdir('/root/workdir/cmin')
+    else:
+        # without coverage information nothing can be dropped
+        kept = listdir('/root/queue')
+    print(json.dumps(sorted(kept)))
+
+
+# build an algorithm without running it, so the build can be cached
+# fuzzing_mode: String (build the instrumented variant in workdir) or None
+def dispatch_building(algorithm, build_args, fuzzing_mode=None):
+    if fuzzing_mode is None:
+        prepare_algorithm(algorithm, build_args)
+    else:
+        chdir('/root/workdir')
+        build_instrumented(build_args, fuzzing_mode)
+        # an algorithm that is a single file has no tree to mark and is
+        # not cached
+        if isdir(join('/root/workdir', algorithm)):
+            open(join('/root/workdir', algorithm, build_marker), 'w').close()
+
+
+# long-lived runner: read one json job per line from stdin and answer
+# with one result frame per input of the job until stdin is closed
+def dispatch_serving():
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        for output in run_batch(
+                job['alg'],
+                str(job['imode']),
+                str(job['omode']),
+                job['exec-args'],
+                job['build-args'],
+                job['files'],
+                str(job['timeout'])
+                ):
+            write_frame(
+                    sys.stdout.buffer,
+                    output,
+                    job.get('compress', False),
+                    job.get('expect', {}).get(output['file'])
+                    )
 
 
 def main(argv):
@@ -231,13 +519,19 @@ def main(argv):
             'fmode=',
             'timeout=',
             'max-cycle=',
-            'file='
+            'file=',
+            'manifest=',
+            'prebuilt',
+            'instance='
             ]
     try:
         opts, args = getopt.getopt(argv, opts, l_opts)
     except getopt.GetoptError as err:
         print(err)
         sys.exit(1)
+    fuzzing_mode = None
+    prebuilt = False
+    instance = 'default'
     for opt, arg in opts:
         if opt in ('-m', '--mode'):
             mode = arg
@@ -259,6 +553,12 @@ def main(argv):
             max_cycle = arg
         elif opt in ('-f', '--file'):
             input_name = arg
+        elif opt == '--manifest':
+            manifest = arg
+        elif opt == '--prebuilt':
+            prebuilt = True
+        elif opt == '--instance':
+            instance = arg
         else:
             sys.exit(1)
 
@@ -271,7 +571,38 @@ def main(argv):
                 build_args,
                 fuzzing_mode,
                 timeout,
-                max_cycle
+                max_cycle,
+                prebuilt,
+                instance
+                )
+    elif mode == 'cmin':
+        dispatch_minimizing(
+                algorithm,
+                exec_args,
+                build_args,
+                fuzzing_mode,
+                prebuilt
+                )
+    elif mode == 'build':
+        dispatch_building(
+                algorithm,
+                build_args,
+                fuzzing_mode
+                )
+    elif mode == 'serve':
+        dispatch_serving()
+    elif mode == 'batch':
+        # the manifest has to be resolved before building changes the path
+        input_names, input_dir = load_manifest(manifest)
+        dispatch_batch(
+                algorithm,
+                input_mode,
+                output_mode,
+                exec_args,
+                build_args,
+                input_names,
+                timeout,
+                input_dir
                 )
     elif mode == 'run':
         dispatch_consuming(
@@ -0,0 +1,52 @@
+import getopt
+import sys
+
+from os         import makedirs
+from os.path    import join, isfile
+from result_store       import Result_Store
+
+
+def usage():
+    print("usage: export_results [-o | --output] DIRECTORY")
+
+
+# write the results of the store of a campaign to the directory layout
+# output_dir/algorithm/{tmp, crashes, false, slow}/input
+def export(output_dir):
+    if not isfile(join(output_dir, 'results.db')):
+        sys.stderr.write("No result store found in {}. Aborting...\n".format(output_dir))
+        sys.stderr.flush()
+        sys.exit(1)
+    store = Result_Store(output_dir)
+    count = 0
+    for algorithm, inp, status, data in store.rows():
+        makedirs(join(output_dir, algorithm, status), exist_ok=True)
+        with open(join(output_dir, algorithm, status, inp), 'wb') as out_file:
+            out_file.write(data)
+        count += 1
+    store.close()
+    print("exported {} results".format(count))
+
+
+def main(argv):
+    output_dir = None
+    try:
+        opts, args = getopt.getopt(argv, "ho:", ["help", "output="])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+        elif opt in ('-o', '--output'):
+            output_dir = arg
+    if output_dir is None:
+        usage()
+        sys.exit(2)
+    export(output_dir)
+
+
+if __name__ == "__main__":
+        main(sys.argv[1:])
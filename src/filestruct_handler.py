@@ -1,11 +1,13 @@
 import hashlib
+import json
 import os
 import shlex
 import shutil
 import stat
 
 from os import sep, listdir, makedirs, remove
-from os.path import join, isfile
+from os.path import join, isfile, isdir, getsize
+from result_store import Result_Store
 
 
 class FST_HANDLER:
@@ -15,6 +17,10 @@ class FST_HANDLER:
         self.output_dir = output_dir
         self.queue = join(output_dir, "queue")
         self.alg_dir = alg_dir
+        # index of the inputs in the queue, loaded on first use
+        self.queue_index = None
+        # results go to the directories unless a result store is opened
+        self.store = None
 
     def get_in(self):
         return self.input_dir
@@ -43,7 +49,7 @@ class FST_HANDLER:
                 exist_ok=True
                 )
 
-        dirs = ["tmp", "crashes", "false"]
+        dirs = ["tmp", "crashes", "false", "slow"]
         for a in algorithms:
             for d in dirs:
                 makedirs(
@@ -71,77 +77,206 @@ class FST_HANDLER:
         out_file = open(path, 'w+')
         return out_file
 
+    # keep the results in a single database in the output directory
+    def open_store(self):
+        self.store = Result_Store(self.output_dir)
+
+    # write the results of the store that are still in memory
+    def flush_store(self):
+        if self.store is not None:
+            self.store.flush()
+
+    def close_store(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    # write the output of a run to the tmp directory
+    # data      : Bytes
+    def put_output(self, algorithm, input_name, data):
+        if self.store is not None:
+            self.store.put(algorithm, input_name, 'tmp', data)
+            return
+        with open(join(self.output_dir, algorithm, 'tmp', input_name), 'wb') as out_file:
+            out_file.write(data)
+
+    # read the output of a run from the tmp directory
+    # returns Bytes or None if there is no output
+    def get_output(self, algorithm, input_name):
+        if self.store is not None:
+            return self.store.get(algorithm, input_name)
+        try:
+            with open(join(self.output_dir, algorithm, 'tmp', input_name), 'rb') as out_file:
+                return out_file.read()
+        except FileNotFoundError:
+            return None
+
+    # write the error output of a failed run to the crashes directory
+    # data      : Bytes
+    def put_crash(self, algorithm, input_name, data):
+        if self.store is not None:
+            self.store.put(algorithm, input_name, 'crashes', data)
+            return
+        with open(join(self.output_dir, algorithm, 'crashes', input_name), 'wb') as out_file:
+            out_file.write(data)
+
+    # write the measurements of a run a lot slower than the ground truth
+    # data      : Bytes
+    def put_slow(self, algorithm, input_name, data):
+        if self.store is not None:
+            self.store.put_slow(algorithm, input_name, data)
+            return
+        with open(join(self.output_dir, algorithm, 'slow', input_name), 'wb') as out_file:
+            out_file.write(data)
+
+    # number of results of an algorithm
+    # category  : String ('tmp', 'crashes', 'false' or 'slow')
+    def count(self, algorithm, category):
+        if self.store is not None:
+            return self.store.count(algorithm, category)
+        return len(listdir(join(self.output_dir, algorithm, category)))
+
     # move a file from the tmp directory to the false directory
+    # or write data straight to it, if the output was never stored
+    # data      : Bytes
     # algorithm     : String (Name of algorithm)
     # output_name   : String (Name of the used input)
-    def put_false(self, algorithm, output_name):
+    def put_false(self, algorithm, output_name, data=None):
+        if self.store is not None:
+            if data is None:
+                self.store.move(algorithm, output_name, 'false')
+            else:
+                self.store.put(algorithm, output_name, 'false', data)
+            return
         tmp_path = join(self.output_dir, algorithm, 'tmp', output_name)
         f_path = join(self.output_dir, algorithm, 'false', output_name)
-        os.rename(tmp_path, f_path)
+        if data is None:
+            os.rename(tmp_path, f_path)
+            return
+        with open(f_path, 'wb') as out_file:
+            out_file.write(data)
 
 
-    # move files form algorithm/tmp/queue into the main queue and rename them
+    # move files form algorithm/tmp/instance/queue into the main queue and rename them
     # algorithm : String (Algorithm used to generate the input)
-    def gen_names(self, algorithm):
+    # instance  : String (Name of the afl++ instance that found the inputs)
+    # returns the names of the inputs added to the queue
+    def gen_names(self, algorithm, instance='default'):
+        added = []
         directories = ['queue', 'crashes', 'hangs']
+        instance_path = join(self.output_dir, algorithm, 'tmp', instance)
         for directory in directories:
-            path = join(self.output_dir, algorithm, 'tmp', directory)
+            path = join(instance_path, directory)
+            if not isdir(path):
+                continue
             files = listdir(path)
             for f in files:
                 if f[:2] != 'id':
                     continue
                 f_path = join(path, f)
-                name = self.gen_name(f, algorithm, directory)
-                os.rename(
-                        join(f_path),
-                        join(
-                            self.output_dir,
-                            'queue',
-                            name
-                            )
-                        )
-            # clean up tmp
-            shutil.rmtree(path)
+                name = self.gen_name(f, algorithm, directory, instance)
+                # duplicates never reach the queue
+                if self.add_to_queue(f_path, name):
+                    added.append(name)
+        # clean up tmp
+        shutil.rmtree(instance_path)
+        self.save_queue_index()
+        return added
+
+    # move a file into the queue unless its content is already there
+    # the index groups the queue by file size, so a file is only hashed
+    # once another file of the same size shows up
+    # returns whether the file was added
+    def add_to_queue(self, path, name):
+        index = self.get_queue_index()
+        size = str(getsize(path))
+        bucket = index.get(size)
+        digest = None
+        if bucket is not None:
+            if bucket['unhashed'] is not None:
+                first = bucket['unhashed']
+                bucket['digests'][digest_file(join(self.queue, first)).hex()] = first
+                bucket['unhashed'] = None
+            digest = digest_file(path).hex()
+            if digest in bucket['digests']:
+                return False
+        os.rename(path, join(self.queue, name))
+        if bucket is None:
+            index[size] = {'unhashed': name, 'digests': {}}
+        else:
+            bucket['digests'][digest] = name
+        return True
+
+    # remove an input from the queue and its index
+    def remove_from_queue(self, name):
+        path = join(self.queue, name)
+        bucket = self.get_queue_index()[str(getsize(path))]
+        if bucket['unhashed'] == name:
+            bucket['unhashed'] = None
+        else:
+            bucket['digests'] = {
+                    digest: inp for digest, inp in bucket['digests'].items()
+                    if inp != name
+                    }
+        remove(path)
+
+    # the persistent index of the queue: size : {unhashed name, digest : name}
+    # loaded from the output directory, rebuilt if it does not match the queue
+    def get_queue_index(self):
+        if self.queue_index is not None:
+            return self.queue_index
+        try:
+            with open(join(self.output_dir, 'queue_index.json')) as index_file:
+                self.queue_index = json.load(index_file)
+        except (FileNotFoundError, ValueError):
+            self.queue_index = {}
+        indexed = sum(
+                len(bucket['digests']) + (bucket['unhashed'] is not None)
+                for bucket in self.queue_index.values()
+                )
+        if indexed != len(listdir(self.queue)):
+            self.queue_remove_duplicates()
+        return self.queue_index
+
+    def save_queue_index(self):
+        if self.queue_index is None:
+            return
+        index_path = join(self.output_dir, 'queue_index.json')
+        with open(index_path + '.tmp', 'w') as index_file:
+            json.dump(self.queue_index, index_file)
+        os.replace(index_path + '.tmp', index_path)
 
 
     # generate a name for an input to store it in the queue
     # input_name: String (Name of the input file: initial or from afl++ )
     # algorithm : String (Name of the algorithm used to generate the input)
-    def gen_name(self, input_name, algorithm, directory):
+    # instance  : String (Name of the afl++ instance; part of the name unless
+    #             it is the only one, as the ids of instances overlap)
+    def gen_name(self, input_name, algorithm, directory, instance='default'):
         name = input_name.split(',')[:3]
         name = ",".join(name)
+        if instance != 'default':
+            algorithm = algorithm + '-' + instance
         name = algorithm + '-' + directory + '-' + name
         return name
 
     # remove redundant inputs from the queue
-    # hash all files in the queue and keep only first of each hash string
+    # rebuild the index of the queue and drop every file already indexed
     def queue_remove_duplicates(self):
-        # maximum block size for sha1
-        BLOCKSIZE=64
-        hashdict = {}
-        rev_hashdict = {}
-        inputs = listdir(self.get_queue())
-
-        # generate hashes for all instances of inputs
-        for inp in inputs:
-            hasher = hashlib.sha1()
-            with open(
-                    join(self.get_queue(), inp),
-                    'rb'
-                    ) as file_handle:
-                buf = file_handle.read(BLOCKSIZE)
-                while len(buf) > 0:
-                    hasher.update(buf)
-                    buf = file_handle.read(BLOCKSIZE)
-            hash_str = hasher.hexdigest()
-            if not hash_str in hashdict:
-                hashdict[hash_str] = inp
-                rev_hashdict[inp] = hash_str
-
-        # remove duplicates
-        for inp in inputs:
-            if not inp in rev_hashdict:
-                remove(
-                    join(self.get_queue(), inp)
-                    )
+        self.queue_index = {}
+        for inp in sorted(listdir(self.get_queue())):
+            path = join(self.get_queue(), inp)
+            if not self.add_to_queue(path, inp):
+                remove(path)
+        self.save_queue_index()
+
 
+# fixed-size digest of a file, read in large chunks
+def digest_file(path):
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file_handle:
+        buf = file_handle.read(1048576)
+        while buf:
+            hasher.update(buf)
+            buf = file_handle.read(1048576)
+    return hasher.digest()
@@ -1,12 +1,16 @@
 import asyncio
+import json
 import os
-import shlex
 import sys
+import tarfile
+import tempfile
+import threading
 
 from os import listdir
 from os.path import join, isfile, isdir
-from subprocess import Popen, PIPE, STDOUT
-from ssh_util import put_dir
+from concurrent.futures import ThreadPoolExecutor
+from ssh_util import exec_wait, get_tar, put_archive_file
+from async_util import client_executor, in_executor
 
 
 class Fuzzing_Server():
@@ -14,144 +18,374 @@ class Fuzzing_Server():
     def __init__(self, aft):
         self.aft = aft
         self.workers = []
+        # algorithm : {afl++ instance : client} of the running campaigns
+        self.groups = {}
+        # held by the sync thread while it touches a client of a group and
+        # by a worker while its client joins or leaves one
+        self.group_lock = threading.Lock()
+        # coroutine called with the names of inputs added to the queue
+        self.on_inputs = None
 
 
     def run(self):
         print('fuzzer running')
+        # duplicates are dropped as inputs enter the queue
         asyncio.run(self.fork_workers())
-        # remove duplicates
-        print('removing duplicates from queue...', end='')
-        self.aft.fh.queue_remove_duplicates()
-        print('done')
+
+
+    # distill the queue to the inputs that afl-cmin keeps for any algorithm
+    def minimize(self):
+        print('minimizing corpus')
+        before = len(listdir(self.aft.queue_dir))
+        asyncio.run(self.fork_minimizers())
+        for inp in listdir(self.aft.queue_dir):
+            if inp not in self.kept:
+                self.aft.fh.remove_from_queue(inp)
+        self.aft.fh.save_queue_index()
+        after = len(listdir(self.aft.queue_dir))
+        print('kept {} of {} inputs (reduced to {:0.2%})'.format(
+            after,
+            before,
+            after / before if before else 1
+            ))
+
+
+    async def fork_minimizers(self):
+        clients = [ client for client_list in self.aft.clients.values() for client in client_list ]
+        self.open(clients)
+        self.kept = set()
+        for algorithm in listdir(self.aft.alg_dir):
+            self.queue.put_nowait(algorithm)
+        self.workers = [ asyncio.create_task(self.minimize_consume(client)) for client in clients ]
+        await self.queue.join()
+        for worker in self.workers:
+            worker.cancel()
+        self.close()
+
+
+    async def minimize_consume(self, client):
+        # setup
+        session = self.aft.sessions[client]
+        await in_executor(self.executor, self.setup_client, client)
+        await in_executor(self.executor, self.deliver_queue, session)
+
+        while True:
+            algorithm = await self.queue.get()
+            print("start minimizing for {}".format(algorithm))
+            build_file = await in_executor(self.executor, self.deliver, session, algorithm)
+            prebuilt = await self.ensure_build(client, algorithm, build_file)
+            kept = await in_executor(self.executor, self.cmin, client, algorithm, build_file, prebuilt)
+            self.kept.update(kept)
+            await in_executor(self.executor, exec_wait, client, 'rm -rf workdir/*')
+            print("done  minimizing for {}: {} inputs kept".format(algorithm, len(kept)))
+            self.queue.task_done()
 
 
     async def fork_workers(self):
-        self.queue = asyncio.Queue()
-        self.fh_lock = asyncio.Lock()
+        clients = [ client for client_list in self.aft.clients.values() for client in client_list ]
+        self.open(clients)
         # create worker list
         self.producer = asyncio.create_task(self.produce())
-        clients = [ client for client_list in self.aft.clients.values() for client in client_list ]
         self.workers = [ asyncio.create_task(self.consume(client)) for client in clients ]
         await asyncio.gather(self.producer)
         await self.queue.join()
         for worker in self.workers:
             worker.cancel()
+        self.close()
+
+
+    # set up queue, locks and threads of the server inside the event loop
+    def open(self, clients):
+        self.queue = asyncio.Queue()
+        self.fh_lock = asyncio.Lock()
+        self.build_locks = {}
+        self.executor = client_executor(clients)
+        # the worker threads are busy with afl++, so syncing gets its own
+        self.sync_executor = ThreadPoolExecutor(max_workers=1)
+        self.syncer = asyncio.create_task(self.sync())
+
+
+    def close(self):
+        self.syncer.cancel()
+        self.executor.shutdown(wait=False)
+        self.sync_executor.shutdown(wait=False)
 
 
     async def produce(self):
+        # one -M and several -S instances per algorithm for parallel campaigns
+        instances = max(1, self.aft.config['global']['afl instances per algorithm'])
         for algorithm in listdir(self.aft.alg_dir):
-            await self.queue.put(algorithm)
+            if instances == 1:
+                await self.queue.put((algorithm, 'default'))
+                continue
+            await self.queue.put((algorithm, 'main'))
+            for i in range(1, instances):
+                await self.queue.put((algorithm, 'secondary{}'.format(i)))
+
+
+    # periodically share the queues of the instances of parallel campaigns
+    async def sync(self):
+        while True:
+            await asyncio.sleep(self.aft.config['global']['afl sync interval'])
+            for algorithm, group in list(self.groups.items()):
+                if len(group) > 1:
+                    await in_executor(
+                            self.sync_executor,
+                            self.exchange,
+                            algorithm,
+                            dict(group)
+                            )
 
 
-    async def consume(self, client):
+    # drain: Boolean (return once the queue is empty instead of waiting)
+    async def consume(self, client, drain=False):
         # setup
-        client.exec_command('mkdir algorithms workdir inputs util')
-        async with self.fh_lock:
-            sftp = client.open_sftp()
-            sftp.put(
-                    join(self.aft.aft_dir, 'dispatch.py'),
-                    'util/dispatch.py'
-                    )
-            # move all input files to remote
-            for fl in listdir(self.aft.input_dir):
-                sftp.put(
-                    join(self.aft.input_dir, fl),
-                    'inputs/{}'.format(fl)
-                    )
-            sftp.close()
+        session = self.aft.sessions[client]
+        await in_executor(self.executor, self.setup_client, client)
 
         # start the working loop
         while True:
-            algorithm = await self.queue.get()
-            print("start fuzzing {}".format(algorithm))
+            if drain and self.queue.empty():
+                return
+            algorithm, instance = await self.queue.get()
+            print("start fuzzing {} ({})".format(algorithm, instance))
             # move algorithm and utility to container
+            build_file = await in_executor(self.executor, self.deliver, session, algorithm)
+            prebuilt = await self.ensure_build(client, algorithm, build_file)
+            await in_executor(self.executor, self.join_group, client, algorithm, instance)
+            await in_executor(self.executor, self.fuzz, client, algorithm, build_file, prebuilt, instance)
+            # waits for a running exchange with the client before workdir is cleaned
+            await in_executor(self.executor, self.leave_group, algorithm, instance)
+            # only the local writes wait for the lock, not the transfer
+            archive = await in_executor(self.executor, self.fetch, client, instance)
             async with self.fh_lock:
-                sftp = client.open_sftp()
-                # check whether the algorithm is a directory
-                alg_path = join(self.aft.alg_dir, algorithm)
-                if isfile(alg_path):
-                    sftp.put(
-                            alg_path,
-                            'algorithms/{}'.format(algorithm)
-                            )
-                elif isdir(alg_path):
-                    put_dir(
-                            sftp,
-                            alg_path,
-                            'algorithms/{}'.format(algorithm)
-                            )
-                else:
-                    sys.stderr.write('Algorithms have to be a file or directory')
-                    sys.stderr.flush()
-                    sys.exit(1)
-                # move auxiliary scripts for the algorithm in place
-                if isfile(self.aft.config[algorithm]['build string']):
-                    build_file = os.path.split(self.aft.config[algorithm]['build string'])[-1]
-                    # check whether it exists in the container
-                    if build_file not in sftp.listdir('util'):
-                        sftp.put(
-                                self.aft.config[algorithm]['build string'],
-                                'util/{}'.format(build_file)
-                                )
-                else:
-                    build_file = self.aft.config[algorithm]['build string']
-                # build script
-                sftp.close()
-            #move algorithm in place
-            client.exec_command('rm -rf workdir/*')
-            client.exec_command('cp -R algorithms/{} workdir/{}'.format(algorithm, algorithm))
-            # run fuzzing dispatcher
-            stdin, stdout, stderr = client.exec_command(
-                """python3 util/dispatch.py --mode fuzz \
-                        --alg {} --imode {} --omode {} \
-                        --exec-args "{}" --build-args "{}" --fmode {} \
-                        --timeout {} --max-cycle {}""".format(
-                            algorithm,
-                            self.aft.config[algorithm]['input format'],
-                            self.aft.config[algorithm]['output format'],
-                            self.aft.config[algorithm]['execution string'],
-                            build_file,
-                            self.aft.config[algorithm]['fuzzing mode'],
-                            self.aft.config['global']['afl running time'] * 60,
-                            self.aft.config['global']['afl iteration limit']
-                            )
+                inputs = await in_executor(self.executor, self.collect, archive, algorithm, instance)
+            if self.on_inputs is not None:
+                await self.on_inputs(inputs)
+
+            # clean workdir
+            await in_executor(self.executor, exec_wait, client, 'rm -rf workdir/*')
+
+            print("done  fuzzing {} ({})".format(algorithm, instance))
+            self.queue.task_done()
+
+
+    # prepare the directories of a client and move the inputs to it
+    def setup_client(self, client):
+        exec_wait(client, 'mkdir -p algorithms workdir inputs util')
+        session = self.aft.sessions[client]
+        session.put_files(
+                [(join(self.aft.aft_dir, 'dispatch.py'), 'dispatch.py')],
+                'util'
+                )
+        # move all input files to remote
+        session.put_files(
+                [
+                    (join(self.aft.input_dir, fl), fl)
+                    for fl in listdir(self.aft.input_dir)
+                    if not session.has_file('inputs', fl)
+                    ],
+                'inputs'
+                )
+
+
+    # move the queue to the client
+    def deliver_queue(self, session):
+        session.put_files(
+                [
+                    (join(self.aft.queue_dir, inp), inp)
+                    for inp in listdir(self.aft.queue_dir)
+                    if not session.has_file('queue', inp)
+                    ],
+                'queue'
+                )
+
+
+    # move the algorithm and its build script to the client
+    # returns the build argument for the dispatcher
+    def deliver(self, session, algorithm):
+        # check whether the algorithm is a directory
+        alg_path = join(self.aft.alg_dir, algorithm)
+        if not session.has_file('algorithms', algorithm):
+            if isfile(alg_path) or isdir(alg_path):
+                session.put_tree(alg_path, 'algorithms', algorithm)
+            else:
+                sys.stderr.write('Algorithms have to be a file or directory')
+                sys.stderr.flush()
+                sys.exit(1)
+        # move auxiliary scripts for the algorithm in place
+        if isfile(self.aft.config[algorithm]['build string']):
+            build_file = os.path.split(self.aft.config[algorithm]['build string'])[-1]
+            # check whether it exists in the container
+            if not session.has_file('util', build_file):
+                session.put_files(
+                        [(self.aft.config[algorithm]['build string'], build_file)],
+                        'util'
                         )
-            for line in stdout:
-                print(line.strip('\n'))
-            for line in stderr:
-                print(line.strip('\n'))
-            commands = [
-                    'docker cp -a aft0:root/workdir/out/queue {}'.format(join(
-                        self.aft.output_dir,
+        else:
+            build_file = self.aft.config[algorithm]['build string']
+        return build_file
+
+
+    # put the instrumented build of the algorithm into the workdir of the client
+    # every build is done once and then shared over the build cache
+    # returns whether the workdir holds a finished build
+    async def ensure_build(self, client, algorithm, build_file):
+        await in_executor(self.executor, exec_wait, client, 'rm -rf workdir/*')
+        if self.aft.build_cache is None:
+            return False
+        # hashing the sources reads every file of the algorithm
+        key = await in_executor(
+                self.executor,
+                self.aft.build_cache.key,
+                join(self.aft.alg_dir, algorithm),
+                self.aft.config[algorithm]['build string'],
+                'fuzz{}'.format(self.aft.config[algorithm]['fuzzing mode']),
+                self.aft.image
+                )
+        build_command = """cp -R algorithms/{0} workdir/{0} && \
+                python3 util/dispatch.py --mode build \
+                    --alg {0} --build-args "{1}" --fmode {2}""".format(
                         algorithm,
-                        'tmp'
-                        )),
-                    'docker cp -a aft0:root/workdir/out/crashes {}'.format(join(
-                        self.aft.output_dir,
+                        build_file,
+                        self.aft.config[algorithm]['fuzzing mode']
+                        )
+        async with self.build_locks.setdefault(key, asyncio.Lock()):
+            built = await in_executor(
+                    self.executor,
+                    self.aft.build_cache.provide,
+                    client,
+                    key,
+                    'workdir',
+                    algorithm,
+                    build_command
+                    )
+        if not built:
+            # let the fuzzing dispatcher build and report the failure
+            await in_executor(self.executor, exec_wait, client, 'rm -rf workdir/*')
+        return built
+
+
+    # build and fuzz an algorithm on the client until afl++ is done
+    # prebuilt: Boolean (the workdir already holds the instrumented build)
+    # instance: String (name of the afl++ instance)
+    def fuzz(self, client, algorithm, build_file, prebuilt, instance):
+        #move algorithm in place
+        if not prebuilt:
+            exec_wait(client, 'cp -R algorithms/{} workdir/{}'.format(algorithm, algorithm))
+        # run fuzzing dispatcher
+        stdin, stdout, stderr = client.exec_command(
+            """python3 util/dispatch.py --mode fuzz \
+                    --alg {} --imode {} --omode {} \
+                    --exec-args "{}" --build-args "{}" --fmode {} \
+                    --timeout {} --max-cycle {} --instance {} {}""".format(
                         algorithm,
-                        'tmp'
-                        )),
-                    'docker cp -a aft0:root/workdir/out/hangs {}'.format(join(
-                        self.aft.output_dir,
+                        self.aft.config[algorithm]['input format'],
+                        self.aft.config[algorithm]['output format'],
+                        self.aft.config[algorithm]['execution string'],
+                        build_file,
+                        self.aft.config[algorithm]['fuzzing mode'],
+                        self.aft.config['global']['afl running time'] * 60,
+                        self.aft.config['global']['afl iteration limit'],
+                        instance,
+                        '--prebuilt' if prebuilt else ''
+                        )
+                    )
+        for line in stdout:
+            print(line.strip('\n'))
+        for line in stderr:
+            print(line.strip('\n'))
+
+
+    # run afl-cmin for an algorithm over the queue on the client
+    # returns the names of the inputs kept
+    def cmin(self, client, algorithm, build_file, prebuilt):
+        if not prebuilt:
+            exec_wait(client, 'cp -R algorithms/{} workdir/{}'.format(algorithm, algorithm))
+        stdin, stdout, stderr = client.exec_command(
+            """python3 util/dispatch.py --mode cmin \
+                    --alg {} --exec-args "{}" --build-args "{}" --fmode {} {}""".format(
                         algorithm,
-                        'tmp'
-                        ))
-                    ]
-            async with self.fh_lock:
-                for cmd in commands:
-                    p = Popen(
-                            shlex.split(cmd),
-                            stdout=PIPE,
-                            stderr=STDOUT
-                            )
-                    stdout = p.communicate()[0]
-                    if stdout.decode() != "":
-                        print(stdout.decode())
-                        sys.exit(1)
-                self.aft.fh.gen_names(algorithm)
+                        self.aft.config[algorithm]['execution string'],
+                        build_file,
+                        self.aft.config[algorithm]['fuzzing mode'],
+                        '--prebuilt' if prebuilt else ''
+                        )
+                    )
+        try:
+            return json.loads(stdout.read())
+        except ValueError:
+            # keep everything if the minimization broke down
+            print(stderr.read().decode())
+            return listdir(self.aft.queue_dir)
 
-            # clean workdir
-            client.exec_command('rm -rf workdir/*')
 
-            print("done  fuzzing {}".format(algorithm))
-            self.queue.task_done()
+    def join_group(self, client, algorithm, instance):
+        with self.group_lock:
+            self.groups.setdefault(algorithm, {})[instance] = client
+
+
+    def leave_group(self, algorithm, instance):
+        with self.group_lock:
+            del self.groups[algorithm][instance]
+
+
+    # whether an instance still runs on the client
+    # call with group_lock held
+    def in_group(self, algorithm, instance, client):
+        return self.groups.get(algorithm, {}).get(instance) is client
+
+
+    # copy the queue of every instance into the sync directories of the others
+    # instances that left the group since the snapshot are skipped, their
+    # client may already run another algorithm
+    # group: {afl++ instance : client} (snapshot of the group)
+    def exchange(self, algorithm, group):
+        for instance, client in group.items():
+            with tempfile.TemporaryFile() as archive:
+                with self.group_lock:
+                    if not self.in_group(algorithm, instance, client):
+                        continue
+                    try:
+                        get_tar(client, 'workdir/out', '{}/queue'.format(instance), archive)
+                    except OSError:
+                        # afl++ did not start on this client yet
+                        continue
+                for other, other_client in group.items():
+                    if other == instance:
+                        continue
+                    archive.seek(0)
+                    with self.group_lock:
+                        if not self.in_group(algorithm, other, other_client):
+                            continue
+                        try:
+                            put_archive_file(other_client, archive, 'workdir/out')
+                        except OSError:
+                            # afl++ of the other instance is shutting down
+                            continue
+
+
+    # fetch the afl++ results of an instance into a temporary file
+    # returns the archive, read from the start
+    def fetch(self, client, instance):
+        archive = tempfile.TemporaryFile()
+        try:
+            get_tar(client, 'workdir/out', instance, archive)
+        except OSError as err:
+            print(err)
+            sys.exit(1)
+        archive.seek(0)
+        return archive
+
+
+    # copy the fetched afl++ results of an instance to the output directory
+    # and move them into the queue
+    # archive: File (from fetch, closed here)
+    # returns the names of the inputs added to the queue
+    def collect(self, archive, algorithm, instance):
+        tmp_path = join(self.aft.output_dir, algorithm, 'tmp')
+        with archive:
+            with tarfile.open(fileobj=archive) as tar:
+                tar.extractall(tmp_path)
+        # inputs harvested while afl++ was running are dropped as duplicates
+        return self.aft.fh.gen_names(algorithm, instance)
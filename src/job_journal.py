@@ -0,0 +1,74 @@
+import json
+import os
+
+from os.path    import isfile
+
+
+class Job_Journal():
+
+    # journal of finished jobs, one json line per algorithm and input
+    # path      : String (File of the journal)
+    # resume    : Boolean (keep the jobs of an earlier run)
+    def __init__(self, path, resume=False):
+        self.path = path
+        # algorithm : {input : entry}
+        self.jobs = {}
+        # lines of added jobs waiting to be written
+        self.lines = []
+        if resume:
+            self.load()
+        self.journal_file = open(self.path, 'a' if resume else 'w')
+
+
+    # read the entries of an earlier run
+    # a line cut off by an interrupt is ignored
+    def load(self):
+        if not isfile(self.path):
+            return
+        with open(self.path) as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.jobs.setdefault(entry['alg'], {})[entry['input']] = entry
+
+
+    def done(self, algorithm, inp):
+        return inp in self.jobs.get(algorithm, {})
+
+
+    def failed(self, algorithm, inp):
+        return self.jobs[algorithm][inp]['failed']
+
+
+    # add a finished job
+    # the line is only written by write, once the results of the job are
+    # written as well, so the journal never holds a job without its results
+    def append(self, algorithm, inp, failed, usage):
+        entry = {'alg': algorithm, 'input': inp, 'failed': failed, 'usage': usage}
+        self.jobs.setdefault(algorithm, {})[inp] = entry
+        self.lines.append(json.dumps(entry) + '\n')
+
+
+    # write the added jobs; they survive an interrupt of aft from here on
+    def write(self):
+        if not self.lines:
+            return
+        self.journal_file.write(''.join(self.lines))
+        self.journal_file.flush()
+        self.lines = []
+
+
+    # treat a job of an earlier run as not done, e.g. if its results are lost
+    def forget(self, algorithm, inp):
+        del self.jobs[algorithm][inp]
+
+
+    # make the appended jobs survive a crash of the host as well
+    def sync(self):
+        os.fsync(self.journal_file.fileno())
+
+
+    def close(self):
+        self.journal_file.close()
@@ -0,0 +1,142 @@
+import asyncio
+import tarfile
+import tempfile
+import time
+
+from os.path            import join
+from concurrent.futures import ThreadPoolExecutor
+from consumer_server    import Consumer_Server
+from fuzzing_server     import Fuzzing_Server
+from ssh_util           import get_tar, list_dir
+from async_util         import in_executor
+
+
+class Pipeline_Server():
+
+    def __init__(self, aft):
+        self.aft = aft
+        self.workers = []
+        self.fz_server = Fuzzing_Server(aft)
+        self.cs_server = Consumer_Server(aft)
+        # (algorithm, afl++ instance) : entries already harvested
+        self.harvested = {}
+
+
+    def run(self):
+        print('Pipeline running')
+        a = time.perf_counter()
+        asyncio.run(self.fork_workers())
+        b = time.perf_counter()
+        print("Pipeline executed {} runs in {:0.4f}s".format(self.cs_server.runs, b - a))
+        self.cs_server.finish()
+
+
+    async def fork_workers(self):
+        clients = [ client for client_list in self.aft.clients.values() for client in client_list ]
+        self.fz_server.open(clients)
+        self.cs_server.open(clients)
+        # everything fuzzing finds goes straight to the consumer
+        self.fz_server.on_inputs = self.cs_server.feed
+        self.harvest_executor = ThreadPoolExecutor(max_workers=1)
+        self.fuzzing_done = asyncio.Event()
+
+        await self.fz_server.produce()
+        # keep at least one client consuming while the others fuzz;
+        # the fuzzing clients join the consumers once fuzzing is done
+        n_fuzz = min(self.fz_server.queue.qsize(), max(1, len(clients) - 1))
+        self.harvester = asyncio.create_task(self.harvest_loop())
+        self.workers = [
+                asyncio.create_task(self.fuzz_then_consume(client))
+                for client in clients[:n_fuzz]
+                ] + [
+                asyncio.create_task(self.cs_server.consume(client))
+                for client in clients[n_fuzz:]
+                ]
+        await self.fz_server.queue.join()
+        self.fuzzing_done.set()
+        await self.harvester
+        await self.cs_server.queue.join()
+        for worker in self.workers:
+            worker.cancel()
+        self.fz_server.close()
+        self.cs_server.close()
+        self.harvest_executor.shutdown(wait=False)
+
+
+    async def fuzz_then_consume(self, client):
+        await self.fz_server.consume(client, drain=True)
+        await self.cs_server.consume(client)
+
+
+    # periodically move new afl++ findings of running instances to the consumer
+    async def harvest_loop(self):
+        while not self.fuzzing_done.is_set():
+            try:
+                await asyncio.wait_for(
+                        self.fuzzing_done.wait(),
+                        self.aft.config['global']['pipeline harvest interval']
+                        )
+            except asyncio.TimeoutError:
+                pass
+            for algorithm, group in list(self.fz_server.groups.items()):
+                for instance, client in list(group.items()):
+                    fetched = await in_executor(
+                            self.harvest_executor,
+                            self.fetch_new,
+                            client,
+                            algorithm,
+                            instance
+                            )
+                    if fetched is None:
+                        continue
+                    # only the local writes wait for the lock, not the transfer
+                    async with self.fz_server.fh_lock:
+                        inputs = await in_executor(
+                                self.harvest_executor,
+                                self.harvest,
+                                algorithm,
+                                instance,
+                                *fetched
+                                )
+                    await self.cs_server.feed(inputs)
+
+
+    # fetch the entries an instance found since the last harvest
+    # the instance is kept in its group meanwhile, so its client is not
+    # cleaned or handed to another algorithm during the transfer
+    # returns the archive and the names of its entries or None
+    def fetch_new(self, client, algorithm, instance):
+        seen = self.harvested.get((algorithm, instance), set())
+        remote_dir = 'workdir/out/{}'.format(instance)
+        with self.fz_server.group_lock:
+            # the instance may have finished and been collected
+            if not self.fz_server.in_group(algorithm, instance, client):
+                return None
+            entries = []
+            for directory in ['queue', 'crashes', 'hangs']:
+                for name in list_dir(client, '{}/{}'.format(remote_dir, directory)):
+                    entry = '{}/{}'.format(directory, name)
+                    if name[:2] == 'id' and entry not in seen:
+                        entries.append(entry)
+            if not entries:
+                return None
+            archive = tempfile.TemporaryFile()
+            try:
+                get_tar(client, remote_dir, entries, archive)
+            except OSError:
+                # afl++ finished in between; the final collect takes over
+                archive.close()
+                return None
+        archive.seek(0)
+        return archive, entries
+
+
+    # move fetched entries of an instance into the queue
+    # archive: File (from fetch_new, closed here)
+    # returns the names of the inputs added to the queue
+    def harvest(self, algorithm, instance, archive, entries):
+        with archive:
+            with tarfile.open(fileobj=archive) as tar:
+                tar.extractall(join(self.aft.output_dir, algorithm, 'tmp', instance))
+        self.harvested.setdefault((algorithm, instance), set()).update(entries)
+        return self.aft.fh.gen_names(algorithm, instance)
@@ -0,0 +1,73 @@
+import json
+import sqlite3
+import zlib
+
+from os.path import join
+
+
+class Result_Cache():
+
+    # cache_dir : String (directory holding the result database)
+    def __init__(self, cache_dir):
+        self.db = sqlite3.connect(join(cache_dir, 'results.db'))
+        columns = [ row[1] for row in self.db.execute('PRAGMA table_info(results)') ]
+        if columns and 'size' not in columns:
+            # written by an older aft, whose results are not used anymore
+            self.db.execute('DROP TABLE results')
+        self.db.execute('''
+                CREATE TABLE IF NOT EXISTS results (
+                    algorithm   TEXT,
+                    input       TEXT,
+                    failed      INTEGER,
+                    size        INTEGER,
+                    digest      TEXT,
+                    stdout      BLOB,
+                    stderr      BLOB,
+                    usage       TEXT,
+                    PRIMARY KEY (algorithm, input)
+                )''')
+        self.db.commit()
+
+    # algorithm : String (content hash of the algorithm and how it is run)
+    # inp       : String (content hash of the input)
+    # returns the cached result or None
+    #         stdout is None if only its size and digest were kept
+    def get(self, algorithm, inp):
+        row = self.db.execute(
+                'SELECT failed, size, digest, stdout, stderr, usage FROM results WHERE algorithm = ? AND input = ?',
+                (algorithm, inp)
+                ).fetchone()
+        if row is None:
+            return None
+        return {
+                'failed': bool(row[0]),
+                'stdout size': row[1],
+                'stdout digest': row[2],
+                'stdout': None if row[3] is None else zlib.decompress(row[3]),
+                'stderr': zlib.decompress(row[4]),
+                'usage': json.loads(row[5])
+                }
+
+    # result    : {'failed', 'stdout', 'stderr', 'usage'} with bytes outputs;
+    #             a stdout of None keeps only its size and digest
+    def put(self, algorithm, inp, result, size, digest):
+        self.db.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    algorithm,
+                    inp,
+                    int(result['failed']),
+                    size,
+                    digest,
+                    None if result['stdout'] is None else zlib.compress(result['stdout']),
+                    zlib.compress(result['stderr']),
+                    json.dumps(result['usage'])
+                    )
+                )
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,149 @@
+import hashlib
+import sqlite3
+
+from os.path    import join
+
+
+class Result_Store():
+
+    # results of a campaign in a single database instead of one file per
+    # algorithm and input in tmp, crashes, false and slow
+    # status is one of 'tmp', 'crashes' and 'false' like the directories;
+    # slow reports are kept apart, since a slow run also has an output
+    # output_dir: String (output directory of the campaign)
+    def __init__(self, output_dir, batch_size=256):
+        self.db = sqlite3.connect(join(output_dir, 'results.db'))
+        # readers never block the consumer and commits need no full sync
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS results (
+                algorithm TEXT,
+                input TEXT,
+                status TEXT,
+                digest TEXT,
+                data BLOB,
+                PRIMARY KEY (algorithm, input)
+                )''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS slow (
+                algorithm TEXT,
+                input TEXT,
+                report BLOB,
+                PRIMARY KEY (algorithm, input)
+                )''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_status ON results (algorithm, status)')
+        self.batch_size = batch_size
+        # rows waiting to be inserted
+        self.results = []
+        self.slow = []
+
+
+    # store a result; rows are written in batches
+    # status: String ('tmp', 'crashes' or 'false')
+    # data  : Bytes
+    def put(self, algorithm, inp, status, data):
+        self.results.append((
+            algorithm,
+            inp,
+            status,
+            hashlib.blake2b(data, digest_size=16).hexdigest(),
+            data
+            ))
+        if len(self.results) >= self.batch_size:
+            self.flush()
+
+
+    def put_slow(self, algorithm, inp, report):
+        self.slow.append((algorithm, inp, report))
+        if len(self.slow) >= self.batch_size:
+            self.flush()
+
+
+    # stored output of a run or None
+    def get(self, algorithm, inp, status='tmp'):
+        self.flush()
+        row = self.db.execute(
+                'SELECT data FROM results WHERE algorithm = ? AND input = ? AND status = ?',
+                (algorithm, inp, status)
+                ).fetchone()
+        return None if row is None else row[0]
+
+
+    # move a stored output to another status
+    def move(self, algorithm, inp, status):
+        self.flush()
+        with self.db:
+            self.db.execute(
+                    'UPDATE results SET status = ? WHERE algorithm = ? AND input = ?',
+                    (status, algorithm, inp)
+                    )
+
+
+    # number of results of an algorithm in a category
+    # category: String ('tmp', 'crashes', 'false' or 'slow')
+    def count(self, algorithm, category):
+        self.flush()
+        if category == 'slow':
+            row = self.db.execute(
+                    'SELECT COUNT(*) FROM slow WHERE algorithm = ?',
+                    (algorithm,)
+                    ).fetchone()
+        else:
+            row = self.db.execute(
+                    'SELECT COUNT(*) FROM results WHERE algorithm = ? AND status = ?',
+                    (algorithm, category)
+                    ).fetchone()
+        return row[0]
+
+
+    # mark every output that differs from the one of the ground truth as
+    # false and drop the ones that match, like the diff of the directories
+    # returns the number of false outputs per algorithm
+    def diff(self, ground_truth):
+        self.flush()
+        with self.db:
+            self.db.execute('''UPDATE results SET status = 'false'
+                    WHERE status = 'tmp' AND algorithm != :gt AND NOT EXISTS (
+                        SELECT 1 FROM results AS reference
+                        WHERE reference.algorithm = :gt
+                        AND reference.status = 'tmp'
+                        AND reference.input = results.input
+                        AND reference.digest = results.digest
+                        )''', {'gt': ground_truth})
+            self.db.execute(
+                    "DELETE FROM results WHERE status = 'tmp' AND algorithm != ?",
+                    (ground_truth,)
+                    )
+        return dict(self.db.execute(
+                "SELECT algorithm, COUNT(*) FROM results WHERE status = 'false' GROUP BY algorithm"
+                ).fetchall())
+
+
+    # every stored result as (algorithm, input, status, data)
+    def rows(self):
+        self.flush()
+        for row in self.db.execute('SELECT algorithm, input, status, data FROM results'):
+            yield row
+        for algorithm, inp, report in self.db.execute('SELECT algorithm, input, report FROM slow'):
+            yield algorithm, inp, 'slow', report
+
+
+    # write the waiting rows in one transaction
+    def flush(self):
+        if not self.results and not self.slow:
+            return
+        with self.db:
+            self.db.executemany(
+                    'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                    self.results
+                    )
+            self.db.executemany(
+                    'INSERT OR REPLACE INTO slow VALUES (?, ?, ?)',
+                    self.slow
+                    )
+        self.results = []
+        self.slow = []
+
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -0,0 +1,142 @@
+import asyncio
+import time
+
+from collections import deque
+
+
+class Scheduler():
+
+    # hands out (algorithm, inputs, kind) jobs to the consuming clients
+    # every client keeps a few jobs in its own queue, sized by its throughput,
+    # and idle clients steal queued jobs of the client with the most work left
+    # workers   : Dictionary (client : name used in the summary)
+    # prefetch  : Integer (jobs an average client keeps queued)
+    def __init__(self, workers, prefetch=2):
+        self.names = workers
+        self.prefetch = max(1, prefetch)
+        self.shared = deque()
+        self.local = {worker: deque() for worker in workers}
+        self.unfinished = 0
+        self.changed = asyncio.Condition()
+        self.finished = asyncio.Event()
+        self.finished.set()
+        # algorithm : [seconds, runs]
+        self.algorithm_time = {}
+        # client : {'busy': seconds, 'runs': runs, 'jobs': jobs, 'stolen': jobs}
+        self.stats = {
+                worker: {'busy': 0.0, 'runs': 0, 'jobs': 0, 'stolen': 0}
+                for worker in workers
+                }
+        self.start = time.perf_counter()
+
+
+    async def put(self, job):
+        self.unfinished += 1
+        self.finished.clear()
+        self.shared.append(job)
+        async with self.changed:
+            self.changed.notify_all()
+
+
+    # next job of a client
+    # waits until there is a job to run or steal
+    async def get(self, worker):
+        async with self.changed:
+            while True:
+                self.refill(worker)
+                if self.local[worker]:
+                    return self.local[worker].popleft()
+                job = self.steal(worker)
+                if job is not None:
+                    return job
+                await self.changed.wait()
+
+
+    # report a job as done
+    # seconds   : Float (time the client spent on the job)
+    # runs      : Integer (runs of the algorithm the job took)
+    def task_done(self, worker, algorithm, seconds, runs):
+        stats = self.stats[worker]
+        stats['busy'] += seconds
+        stats['runs'] += runs
+        stats['jobs'] += 1
+        if runs:
+            timing = self.algorithm_time.setdefault(algorithm, [0.0, 0])
+            timing[0] += seconds
+            timing[1] += runs
+        self.unfinished -= 1
+        if self.unfinished == 0:
+            self.finished.set()
+
+
+    async def join(self):
+        await self.finished.wait()
+
+
+    # move jobs of the shared queue to the queue of a client
+    # fast clients take more jobs, so they run dry at about the same time
+    def refill(self, worker):
+        target = round(self.prefetch * self.relative_speed(worker))
+        while self.shared and len(self.local[worker]) < max(1, target):
+            self.local[worker].append(self.shared.popleft())
+
+
+    # take the last job of the client with the most expected work queued
+    def steal(self, worker):
+        victim = max(
+                self.local,
+                key=lambda other: sum(self.cost(job) for job in self.local[other]),
+                )
+        if not self.local[victim]:
+            return None
+        self.stats[worker]['stolen'] += 1
+        return self.local[victim].pop()
+
+
+    # runs per second of a client compared to the average client
+    # clients without finished runs count as average, jobs answered from
+    # the result cache take time but no runs
+    def relative_speed(self, worker):
+        speeds = [
+                stats['runs'] / stats['busy']
+                for stats in self.stats.values()
+                if stats['runs'] > 0 and stats['busy'] > 0
+                ]
+        stats = self.stats[worker]
+        if not speeds or stats['runs'] == 0 or stats['busy'] == 0:
+            return 1.0
+        return (stats['runs'] / stats['busy']) / (sum(speeds) / len(speeds))
+
+
+    # expected seconds of a job from the average runtime of its algorithm
+    # algorithms that never ran cost as much as the average algorithm
+    def cost(self, job):
+        algorithm, inputs, kind = job
+        averages = [
+                seconds / runs
+                for seconds, runs in self.algorithm_time.values()
+                ]
+        try:
+            seconds, runs = self.algorithm_time[algorithm]
+            average = seconds / runs
+        except KeyError:
+            average = sum(averages) / len(averages) if averages else 1.0
+        return average * len(inputs)
+
+
+    # per client utilisation and throughput
+    def summary(self):
+        wall = time.perf_counter() - self.start
+        lines = []
+        for worker, stats in self.stats.items():
+            lines.append("  {}: {} runs in {} jobs ({} stolen), busy {:0.1f}% ({:0.2f} runs/s)".format(
+                self.names[worker],
+                stats['runs'],
+                stats['jobs'],
+                stats['stolen'],
+                100 * stats['busy'] / wall if wall > 0 else 0,
+                stats['runs'] / stats['busy'] if stats['busy'] > 0 else 0
+                ))
+        for algorithm, (seconds, runs) in sorted(self.algorithm_time.items()):
+            lines.append("  {}: {:0.4f}s per run".format(algorithm, seconds / runs))
+        return "\n".join(lines)
@@ -1,14 +1,19 @@
+import hashlib
+import os
 import sys
 import shlex
 import paramiko
+import tarfile
+import time
 
 from binascii           import hexlify
 from os                 import listdir
-from os.path            import dirname, realpath, join, isfile, isdir
+from os.path            import dirname, realpath, join, isfile, isdir, getsize
 from pathlib            import Path
 from paramiko           import RSAKey
 from paramiko.py3compat import u
 from subprocess         import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.hazmat.primitives     import serialization
 
 
@@ -29,44 +34,90 @@ def gen_dockerfile(host_rsakey, dependencies):
     return docker_str
 
 
+# load the container host key from filename, generate it on first use
+# keeping the key keeps the dockerfile and with it the image stable
 def gen_rsa_key(filename):
 
-    private_key_obj = RSAKey.generate(bits=1024)
-    private_key = private_key_obj.key.private_bytes(
+    if not isfile(filename):
+        RSAKey.generate(bits=1024).write_private_key_file(filename)
+    public_key_obj  = RSAKey(filename=filename)
+    private_key = public_key_obj.key.private_bytes(
             serialization.Encoding.PEM,
             serialization.PrivateFormat.TraditionalOpenSSL,
             serialization.NoEncryption()
             ).decode()
-    private_key_obj.write_private_key_file('aft_container_host_key')
-    public_key_obj  = RSAKey(filename='aft_container_host_key')
 
     return private_key, public_key_obj
 
 
-def get_clients(worker_config, rsa_pub, host_key_file, dependencies):
+# tag of the image built from a dockerfile, changes with its content
+def get_image_tag(dockerfile):
+    return 'aft:{}'.format(hashlib.sha256(dockerfile.encode()).hexdigest()[:16])
 
+
+def has_image(image):
+    p = Popen(
+            shlex.split('docker image inspect {}'.format(image)),
+            stdout=PIPE,
+            stderr=PIPE
+            )
+    p.communicate()
+    return p.returncode == 0
+
+
+# start and connect all instances of all workers
+# parallelism: Integer (number of containers started at once)
+# returns the clients and the startup time in seconds per worker and instance
+def get_clients(worker_config, rsa_pub, host_key_file, image, parallelism=8):
+
+    def start(worker, instance):
+        a = time.perf_counter()
+        if worker_config[worker]['remote'] is False:
+            client = get_local_session(
+                    rsa_pub,
+                    image,
+                    instance
+                    )
+        else:
+            client = get_remote_session(
+                    worker_config[worker],
+                    rsa_pub,
+                    host_key_file,
+                    image,
+                    instance
+                    )
+        return client, time.perf_counter() - a
+
+    with ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+        futures = {
+                worker: [
+                    executor.submit(start, worker, instance)
+                    for instance in range(0, worker_config[worker]['instances'])
+                    ]
+                for worker in worker_config
+                }
     out = {}
-    for worker in worker_config:
-        out[worker] = []
-        for instance in range(0, worker_config[worker]['instances']):
-            if worker_config[worker]['remote'] is False:
-                client = get_local_session(
-                        rsa_pub,
-                        dependencies,
-                        instance
-                        )
-            else:
-                client = get_remote_session(
-                        worker_config[worker],
-                        rsa_pub,
-                        host_key_file,
-                        dependencies,
-                        instance
-                        )
-            out[worker].append(client)
-    return out
+    timings = {}
+    for worker in futures:
+        out[worker] = [future.result()[0] for future in futures[worker]]
+        timings[worker] = [future.result()[1] for future in futures[worker]]
+    return out, timings
+
 
-def get_remote_session(config, rsa_pub, host_key_file, dependencies, instance):
+# connect to the sshd of a fresh container as soon as it accepts connections
+# timeout: Integer (seconds to keep polling)
+def connect_when_ready(client, host, port, timeout=60, **kwargs):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            client.connect(host, port=port, **kwargs)
+            return
+        except (paramiko.SSHException, OSError, EOFError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+def get_remote_session(config, rsa_pub, host_key_file, image, instance):
     # connect to remote host
     client = paramiko.SSHClient()
     client.load_host_keys(os.path.expanduser(host_key_file))
@@ -78,22 +129,22 @@ def get_remote_session(config, rsa_pub, host_key_file, dependencies, instance):
             )
     #TODO
     # build docker container
-    stdin, stdout, stderr = client.exec_command('docker build -t aft:1.0 -')
+    stdin, stdout, stderr = client.exec_command('docker build -t {} -'.format(image))
     stdin.write(docker_string)
     if err := stderr.read():
         sys.stderr.write(err)
         sys.stderr.flush()
         sys.exit(1)
     # run docker container
-    stdin, stdout, stderr = client.exec_command('docker run -d -P --name aft{} aft:1.0'.format(instance))
+    stdin, stdout, stderr = client.exec_command('docker run -d -P --name aft{} {}'.format(instance, image))
     # forward all ssh traffic
     # return client
     pass
 
-def get_local_session(rsa_pub, dependencies, instance):
+def get_local_session(rsa_pub, image, instance):
     # start docker container
     p = Popen(
-            shlex.split('docker run -d -P --name aft{} aft:1.0'.format(instance)),
+            shlex.split('docker run -d -P --name aft{} {}'.format(instance, image)),
             stdout=PIPE,
             stderr=PIPE
             )
@@ -128,15 +179,14 @@ def get_local_session(rsa_pub, dependencies, instance):
             'ssh-rsa',
             rsa_pub
             )
-    client.connect(
+    connect_when_ready(
+            client,
             '0.0.0.0',
-            port=port,
+            port,
             username='root',
             password='pass'
             )
-    sin, sout, serr = client.exec_command(
-            'apt-get update && apt-get install -y {}'.format(dependencies)
-            )
+    # dependencies are installed when the image is built
     # return client
     return client
 
@@ -188,3 +238,184 @@ def put_dir(sftp, dir_path, dest_path):
                     )
         else:
             pass
+
+
+# run a command on a client and wait until it finished
+# the output is read and dropped, so a chatty command (e.g. a build) never
+# fills the channel window and blocks
+# returns the exit status of the command
+def exec_wait(client, command):
+    stdin, stdout, stderr = client.exec_command(command)
+    stdout.channel.set_combine_stderr(True)
+    while stdout.read(32768):
+        pass
+    return stdout.channel.recv_exit_status()
+
+
+# stream files as one tar archive over a single channel and unpack remotely
+# client    : paramiko client
+# files     : List of (local path, name in the archive); directories recurse
+# dest_path : String (remote directory to unpack into)
+def put_tar(client, files, dest_path):
+    stdin, stdout, stderr = client.exec_command(
+            'mkdir -p {0} && tar -x -C {0}'.format(shlex.quote(dest_path))
+            )
+    with tarfile.open(fileobj=stdin, mode='w|') as tar:
+        for local_path, name in files:
+            tar.add(local_path, arcname=name)
+    stdin.flush()
+    stdin.channel.shutdown_write()
+    if stdout.channel.recv_exit_status() != 0:
+        raise OSError(stderr.read().decode())
+
+
+# stream remote files or directories as tar archive into a local file
+# remote_dir: String (remote directory containing the entries)
+# names     : String or List of String (entries to archive)
+# out_file  : binary file object the archive is written to
+def get_tar(client, remote_dir, names, out_file):
+    if isinstance(names, str):
+        names = [names]
+    # names are passed on stdin so long lists do not hit the argument limit
+    stdin, stdout, stderr = client.exec_command(
+            'tar -c -C {} -T -'.format(shlex.quote(remote_dir))
+            )
+    stdin.write(''.join('{}\n'.format(name) for name in names))
+    stdin.flush()
+    stdin.channel.shutdown_write()
+    buf = stdout.read(65536)
+    while buf:
+        out_file.write(buf)
+        buf = stdout.read(65536)
+    if stdout.channel.recv_exit_status() != 0:
+        raise OSError(stderr.read().decode())
+
+
+# names in a remote directory, empty if it does not exist
+def list_dir(client, path):
+    stdin, stdout, stderr = client.exec_command(
+            'ls -1 -A {}'.format(shlex.quote(path))
+            )
+    names = stdout.read().decode().splitlines()
+    stdout.channel.recv_exit_status()
+    return names
+
+
+# stream a local tar archive to a client and unpack it there
+def put_archive(client, archive_path, dest_path):
+    with open(archive_path, 'rb') as archive:
+        put_archive_file(client, archive, dest_path)
+
+
+# stream an open tar archive to a client and unpack it there
+def put_archive_file(client, archive, dest_path):
+    stdin, stdout, stderr = client.exec_command(
+            'mkdir -p {0} && tar -x -C {0}'.format(shlex.quote(dest_path))
+            )
+    buf = archive.read(65536)
+    while buf:
+        stdin.write(buf)
+        buf = archive.read(65536)
+    stdin.flush()
+    stdin.channel.shutdown_write()
+    if stdout.channel.recv_exit_status() != 0:
+        raise OSError(stderr.read().decode())
+
+
+# number of files and total size below a file or directory
+def tree_size(path):
+    if isfile(path):
+        return 1, getsize(path)
+    count, size = 0, 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            count += 1
+            size += getsize(join(root, f))
+    return count, size
+
+
+class Client_Session():
+
+    # bulk_count: Integer (number of files from which on tar streams are used)
+    # bulk_size : Integer (total bytes from which on tar streams are used)
+    def __init__(self, client, bulk_count=16, bulk_size=1048576):
+        self.client = client
+        self.sftp = None
+        # remote directory : set of names already delivered to the client
+        # listed from the client once and reset whenever sftp reconnects
+        self.manifest = {}
+        self.bulk_count = bulk_count
+        self.bulk_size = bulk_size
+
+    # return the persistent sftp session of the client, reopen it if closed
+    def get_sftp(self):
+        if self.sftp is None or self.sftp.sock.closed:
+            self.sftp = self.client.open_sftp()
+            self.manifest = {}
+        return self.sftp
+
+    # call a method of the sftp session
+    # the session is reopened and the call retried once if it broke down
+    def sftp_call(self, method, *args):
+        for attempt in range(2):
+            sftp = self.get_sftp()
+            try:
+                return getattr(sftp, method)(*args)
+            except (EOFError, paramiko.SSHException, OSError):
+                if attempt or not sftp.sock.closed:
+                    raise
+                self.sftp = None
+
+    # names in a remote directory, only listed remotely on first use
+    def remote_files(self, directory):
+        if directory not in self.manifest:
+            try:
+                self.manifest[directory] = set(self.sftp_call('listdir', directory))
+            except FileNotFoundError:
+                self.manifest[directory] = set()
+        return self.manifest[directory]
+
+    def has_file(self, directory, name):
+        # make sure the manifest is still valid for the current session
+        self.get_sftp()
+        return name in self.remote_files(directory)
+
+    def use_bulk(self, count, size):
+        return count >= self.bulk_count or size >= self.bulk_size
+
+    # move files into a remote directory
+    # files     : List of (local path, remote name)
+    # dest_path : String (remote directory)
+    def put_files(self, files, dest_path):
+        if not files:
+            return
+        size = sum(getsize(local_path) for local_path, name in files)
+        if self.use_bulk(len(files), size):
+            put_tar(self.client, files, dest_path)
+        else:
+            for local_path, name in files:
+                self.sftp_call(
+                        'put',
+                        local_path,
+                        '{}/{}'.format(dest_path, name)
+                        )
+        self.remote_files(dest_path).update(name for local_path, name in files)
+
+    # move a file or directory into a remote directory under the given name
+    def put_tree(self, local_path, dest_path, name):
+        if isfile(local_path):
+            self.put_files([(local_path, name)], dest_path)
+        elif self.use_bulk(*tree_size(local_path)):
+            put_tar(self.client, [(local_path, name)], dest_path)
+        else:
+            put_dir(
+                    self.get_sftp(),
+                    local_path,
+                    '{}/{}'.format(dest_path, name)
+                    )
+        self.remote_files(dest_path).add(name)
+
+    def close(self):
+        if self.sftp is not None:
+            self.sftp.close()
+            self.sftp = None